@@ -0,0 +1,145 @@
+import os
+import json
+import base64
+from math import pi
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+from flask import request, jsonify, Response, stream_with_context
+from layout import server
+from profiling import profiled, attributed
+from preprocess import (WAVELENGTHS, SWEEP_SCALES, XRDCalculator, cif_contents, load_crystal, load_pattern,
+                        lattice_matrix)
+
+# Largest batch accepted by one request and number of worker threads.
+API_MAX_PHASES = 500
+API_WORKERS = min(8, os.cpu_count() or 1)
+LATTICE_KEYS = ("a", "b", "c", "alpha", "beta", "gamma")
+# Shortest wavelength (angstroms) and most reflections (estimated) computed
+# for one phase; both bound the memory a single request can take.
+API_MIN_WAVELENGTH = 0.5
+API_MAX_REFLECTIONS = 10 ** 6
+
+_executor = ThreadPoolExecutor(max_workers=API_WORKERS)
+
+def encode_array(values):
+    """
+    Little-endian float32 array in the same {"dtype", "bdata"} form plotly
+    uses for typed arrays.
+    """
+    data = np.asarray(values, dtype="<f4")
+    return {"dtype": "f4", "bdata": base64.b64encode(data.tobytes()).decode("ascii")}
+
+def _check_lattice(parameters):
+    """
+    Raise ValueError unless parameters (a, b, c, alpha, beta, gamma) are a
+    real cell: positive lengths, and angles that close a cell of positive
+    volume.
+    """
+    if not np.all(np.isfinite(parameters)) or min(parameters[:3]) <= 0:
+        raise ValueError("Lattice lengths must be positive")
+    angles = np.radians(parameters[3:])
+    cos = np.cos(angles)
+    if np.any((angles <= 0) | (angles >= pi)) or 1 - np.sum(cos ** 2) + 2 * np.prod(cos) <= 0:
+        raise ValueError("Lattice angles must be within (0, 180) and form a valid cell")
+
+def _compute(phase, wavelength, two_theta_range, with_hkl):
+    """
+    Pattern of one requested phase as a JSON-ready dict; errors are
+    reported per phase so one bad CIF does not fail the batch.
+    """
+    name = phase.get("name")
+    try:
+        contents = cif_contents(phase["cif"])
+        crystal = load_crystal(contents)
+        parameters = crystal.parameters
+        overrides = phase.get("lattice") or {}
+        if overrides:
+            current = dict(zip(LATTICE_KEYS, parameters))
+            current.update({k: float(v) for k, v in overrides.items() if k in LATTICE_KEYS})
+            parameters = tuple(current[k] for k in LATTICE_KEYS)
+            _check_lattice(parameters)
+        scale = float(phase.get("scale", 0))
+        if not np.isclose(SWEEP_SCALES, scale, rtol=0, atol=1e-6).any():
+            raise ValueError(f"scale must be between {SWEEP_SCALES[0]:g} and {SWEEP_SCALES[-1]:g} in steps of 0.1")
+        reflections = XRDCalculator(wavelength).reflection_count(
+            crystal.with_lattice(lattice_matrix(*parameters)), (scale,), two_theta_range)
+        if reflections > API_MAX_REFLECTIONS:
+            raise ValueError(f"About {reflections:.3g} reflections, more than {API_MAX_REFLECTIONS}; "
+                             "narrow two_theta_range or use a longer wavelength")
+        pattern = load_pattern(contents, parameters, scale, wavelength, two_theta_range)
+        result = {
+            "name": name,
+            "two_theta": encode_array(pattern.x),
+            "intensity": encode_array(pattern.y),
+            "d": encode_array(pattern.d_hkls),
+        }
+        if with_hkl:
+            result["hkl"] = [[{"hkl": list(f["hkl"]), "multiplicity": f["multiplicity"]} for f in fams]
+                             for fams in pattern.hkls]
+        return result
+    except Exception as e:
+        return {"name": name, "error": str(e)}
+
+@server.route("/api/patterns", methods=["POST"])
+@profiled
+def compute_patterns():
+    """
+    Compute a batch of patterns with the engine behind the UI.
+
+    Request JSON:
+        {"phases": [{"name": str, "cif": str (CIF text),
+                     "lattice": {"a": .., "gamma": ..} (optional, partial),
+                     "scale": percent, -5 to 5 in steps of 0.1 (optional)}, ...],
+         "wavelength": "CuKa" or angstroms, at least API_MIN_WAVELENGTH (optional),
+         "two_theta_range": [min, max] (optional, default [10, 120]),
+         "hkl": true to include hkl families (optional)}
+
+    Returns {"patterns": [...]} in request order, each with base64 float32
+    "two_theta", "intensity" and "d" arrays (or an "error"). With ?stream=1
+    or "Accept: application/x-ndjson", one JSON line is streamed per phase
+    as soon as it is done, tagged with its "index" in the request.
+    """
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or not isinstance(payload.get("phases"), list):
+        return jsonify({"error": "Expected a JSON object with a 'phases' list"}), 400
+    phases = payload["phases"]
+    if len(phases) > API_MAX_PHASES:
+        return jsonify({"error": f"At most {API_MAX_PHASES} phases per request"}), 400
+    if any(not isinstance(p, dict) or not isinstance(p.get("cif"), str) for p in phases):
+        return jsonify({"error": "Every phase needs a 'cif' string"}), 400
+    wavelength = payload.get("wavelength", "CuKa")
+    known = isinstance(wavelength, str) and wavelength in WAVELENGTHS
+    numeric = (isinstance(wavelength, (int, float)) and not isinstance(wavelength, bool)
+               and np.isfinite(wavelength) and wavelength >= API_MIN_WAVELENGTH)
+    if not (known or numeric):
+        return jsonify({"error": f"wavelength must be one of {sorted(WAVELENGTHS)} "
+                                 f"or at least {API_MIN_WAVELENGTH} angstroms"}), 400
+    try:
+        two_theta_range = tuple(float(t) for t in payload.get("two_theta_range", (10, 120)))
+    except (TypeError, ValueError):
+        two_theta_range = ()
+    if len(two_theta_range) != 2 or not 0 <= two_theta_range[0] < two_theta_range[1] <= 180:
+        return jsonify({"error": "two_theta_range must be [min, max] within 0-180"}), 400
+    with_hkl = bool(payload.get("hkl", False))
+
+    def submit():
+        task = attributed(_compute)
+        return {_executor.submit(task, phase, wavelength, two_theta_range, with_hkl): i
+                for i, phase in enumerate(phases)}
+
+    stream = request.args.get("stream") == "1" or "application/x-ndjson" in request.headers.get("Accept", "")
+    if stream:
+        # Profiled on its own, and submitting from there so the workers are
+        # sampled for it: the results are produced after this view returns.
+        @profiled
+        def stream_patterns():
+            futures = submit()
+            for future in as_completed(futures):
+                yield json.dumps({"index": futures[future], **future.result()}) + "\n"
+        return Response(stream_with_context(stream_patterns()), mimetype="application/x-ndjson")
+
+    futures = submit()
+    results = [None] * len(phases)
+    for future in as_completed(futures):
+        results[futures[future]] = future.result()
+    return jsonify({"wavelength": wavelength, "two_theta_range": list(two_theta_range), "patterns": results})
@@ -1,7 +1,16 @@
+import os
+import threading
 from layout import app
 import callbacks  
+import api
+from preprocess import warm_store
 
 server = app.server  
 
+# Optionally precompute the reference phases in XRD_WARMUP_DIR into the
+# shared pattern store, in the background.
+if os.environ.get("XRD_WARMUP_DIR"):
+    threading.Thread(target=warm_store, args=(os.environ["XRD_WARMUP_DIR"],), daemon=True).start()
+
 if __name__ == "__main__":
     app.run(debug=True, port=8050)
@@ -0,0 +1,55 @@
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used mapping for values functools.lru_cache
+    cannot hold: keyed on arrays (see array_key) or bounded by the size of
+    the values. Holds at most max_items entries and, when size is given, at
+    most max_size of size(value) summed; the newest entry is always kept.
+    """
+    def __init__(self, max_items=None, max_size=None, size=None):
+        self.max_items = max_items
+        self.max_size = max_size
+        self.size = size
+        self._entries = OrderedDict()
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._entries.get(key, default)
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """
+        Store value under key, evicting the least recently used entries
+        beyond the bounds. Returns value.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._total -= self._sizeof(self._entries.pop(key))
+            self._entries[key] = value
+            self._total += self._sizeof(value)
+            while len(self._entries) > 1 and (
+                (self.max_items is not None and len(self._entries) > self.max_items)
+                or (self.max_size is not None and self._total > self.max_size)
+            ):
+                self._total -= self._sizeof(self._entries.popitem(last=False)[1])
+        return value
+
+    def _sizeof(self, value):
+        return self.size(value) if self.size is not None else 0
+
+def array_key(values):
+    """
+    Content hash of a float array, for cache keys that include a 2θ grid.
+    """
+    return hashlib.sha1(np.ascontiguousarray(values, dtype=float).tobytes()).hexdigest()
@@ -1,12 +1,17 @@
 import base64
+import numpy as np
 import pandas as pd
 import json
-from dash import Input, Output, State, no_update
+from dash import Input, Output, State, Patch, ctx, no_update
+from dash.exceptions import PreventUpdate
 import plotly.graph_objects as go
 from layout import app, max_files  # import max_files from layout (max_files = 8)
-from preprocess import parse_xy, parse_cif, normalize_structure, XRDCalculator
-from plot import plot_xrd
-from pymatgen.core import Structure
+from preprocess import load_processed_xy, preprocess_xy, load_crystal, load_sweep, load_profile, lattice_matrix
+from plot import plot_xrd, plot_series, series_marker, series_overlay
+from series import build_series, load_series, series_scan
+from profiling import profiled
+from debye import load_debye, debye_grid
+from scoring import find_peaks, score_pattern, format_score, fit_phase_scales, weight_fractions
 import plotly.io as pio
 
 # ------------------------------------------------------------------
@@ -33,22 +38,46 @@ def update_cif_status(contents_list):
 # ------------------------------------------------------------------
 # Store Uploaded Files Callbacks
 # ------------------------------------------------------------------
+# The shown scan comes from the single upload or from the scan series,
+# whichever was picked last; xy-source records which, so toggling the
+# preprocessing options re-processes that one.
 @app.callback(
-    Output("xy-store", "data"),
-    Input("upload-xy", "contents"),
-    State("upload-xy", "filename")
+    [Output("xy-store", "data"),
+     Output("xy-source", "data")],
+    [Input("upload-xy", "contents"),
+     Input("series-index", "value"),
+     Input("xy-options", "value")],
+    [State("upload-xy", "filename"),
+     State("series-store", "data"),
+     State("xy-source", "data")]
 )
-def store_xy_file(contents, filename):
-    if contents is not None:
+@profiled
+def store_xy_file(contents, index, options, filename, series_data, source):
+    if ctx.triggered_id == "upload-xy":
+        source = "upload"
+    elif ctx.triggered_id == "series-index":
+        source = "series"
+    options = options or []
+    if source == "series":
+        if not series_data or index is None:
+            return no_update, source
         try:
-            df = parse_xy(contents)
-            max_intensity = df['intensity'].max()
-            df['intensity'] = (df['intensity'] / max_intensity) * 100
-            return df.to_json(date_format='iso', orient='split')
+            two_theta, intensity = series_scan(series_data["id"], index)
+            intensity = preprocess_xy(two_theta, intensity, **{option: True for option in options})
+        except Exception as e:
+            print("Error selecting scan", index, ":", e)
+            return no_update, source
+    elif contents is not None:
+        try:
+            # Parsing and preprocessing are cached per upload and option set.
+            two_theta, intensity = load_processed_xy(contents, tuple(sorted(options)))
         except Exception as e:
             print("Error processing XY file:", e)
-            return no_update
-    return no_update
+            return no_update, source
+    else:
+        return no_update, source
+    df = pd.DataFrame({'2_theta': two_theta, 'intensity': intensity})
+    return df.to_json(date_format='iso', orient='split'), source
 
 @app.callback(
     Output("cif-store", "data"),
@@ -66,6 +95,64 @@ def store_cif_files(contents_list, filenames):
         return cif_data
     return no_update
 
+# ------------------------------------------------------------------
+# Scan Series Callbacks
+# ------------------------------------------------------------------
+@app.callback(
+    [Output("series-store", "data"),
+     Output("series-index", "max"),
+     Output("series-index", "value"),
+     Output("series-upload-status", "children")],
+    Input("upload-xy-series", "contents"),
+    State("upload-xy-series", "filename")
+)
+@profiled
+def store_series(contents_list, filenames):
+    if not contents_list:
+        return no_update, no_update, no_update, no_update
+    try:
+        # The scans are resampled into a memory-mapped array on disk; only
+        # its id and the file names are kept in the browser.
+        order = sorted(range(len(filenames)), key=lambda k: filenames[k])
+        sid = build_series([contents_list[k] for k in order])
+    except Exception as e:
+        print("Error processing XY series:", e)
+        return no_update, no_update, no_update, ""
+    names = [filenames[k] for k in order]
+    return {"id": sid, "names": names}, len(names) - 1, 0, "✓"
+
+@app.callback(
+    Output("series-plot", "figure"),
+    [Input("series-store", "data"),
+     Input("series-mode", "value"),
+     Input("series-index", "value"),
+     Input("phase-positions", "data")]
+)
+@profiled
+def update_series_plot(series_data, mode, index, positions):
+    if not series_data:
+        return {}
+    try:
+        grid, data = load_series(series_data["id"])
+    except Exception as e:
+        print("Error loading XY series:", e)
+        return {}
+    index = index or 0
+    positions = positions or {}
+    triggered = {t.split(".")[0] for t in ctx.triggered_prop_ids}
+    # Moving through scans or editing phases only patches the marker and
+    # overlay traces; the series itself is sent once per series and mode.
+    if triggered and triggered <= {"series-index", "phase-positions"}:
+        patched = Patch()
+        if "series-index" in triggered:
+            x_range = [float(grid[0]), float(grid[-1])]
+            patched["data"][1] = series_marker(index, data.shape[0], mode, x_range).to_plotly_json()
+        if "phase-positions" in triggered:
+            for k, trace in enumerate(series_overlay(positions, data.shape[0], mode, max_files)):
+                patched["data"][2 + k] = trace.to_plotly_json()
+        return patched
+    return plot_series(grid, data, index, positions, mode=mode, slots=max_files)
+
 # ------------------------------------------------------------------
 # Lattice Parameter Blocks Update Callback (for 8 blocks)
 # ------------------------------------------------------------------
@@ -80,6 +167,7 @@ def store_cif_files(contents_list, filenames):
     [Output(f"lattice-{i}-gamma", "value") for i in range(1, max_files+1)],
     Input("cif-store", "data")
 )
+@profiled
 def update_lattice_params_blocks(cif_data):
     style_outputs = []
     header_outputs = []
@@ -96,9 +184,7 @@ def update_lattice_params_blocks(cif_data):
     for i in range(max_files):
         if i < num_files:
             try:
-                structure = parse_cif(cif_data[file_names[i]])
-                structure = normalize_structure(structure)
-                lattice = structure.lattice
+                a, b, c, alpha, beta, gamma = load_crystal(cif_data[file_names[i]]).parameters
                 style_outputs.append({
                     "display": "inline-block",
                     "width": "90%",
@@ -110,12 +196,12 @@ def update_lattice_params_blocks(cif_data):
                     "fontSize": "24px"
                 })
                 header_outputs.append(file_names[i])
-                a_outputs.append(round(lattice.a, 4))
-                b_outputs.append(round(lattice.b, 4))
-                c_outputs.append(round(lattice.c, 4))
-                alpha_outputs.append(round(lattice.alpha, 4))
-                beta_outputs.append(round(lattice.beta, 4))
-                gamma_outputs.append(round(lattice.gamma, 4))
+                a_outputs.append(round(a, 4))
+                b_outputs.append(round(b, 4))
+                c_outputs.append(round(c, 4))
+                alpha_outputs.append(round(alpha, 4))
+                beta_outputs.append(round(beta, 4))
+                gamma_outputs.append(round(gamma, 4))
             except Exception as e:
                 print("Error parsing CIF for lattice block:", e)
                 style_outputs.append({"display": "none"})
@@ -158,16 +244,14 @@ def make_reset_callback(i):
         if not cif_data or not file_name:
             return no_update, no_update, no_update, no_update, no_update, no_update
         try:
-            structure = parse_cif(cif_data[file_name])
-            structure = normalize_structure(structure)
-            lattice = structure.lattice
+            a, b, c, alpha, beta, gamma = load_crystal(cif_data[file_name]).parameters
             return (
-                round(lattice.a, 4),
-                round(lattice.b, 4),
-                round(lattice.c, 4),
-                round(lattice.alpha, 4),
-                round(lattice.beta, 4),
-                round(lattice.gamma, 4)
+                round(a, 4),
+                round(b, 4),
+                round(c, 4),
+                round(alpha, 4),
+                round(beta, 4),
+                round(gamma, 4)
             )
         except Exception as e:
             print("Error in reset callback for", file_name, ":", e)
@@ -201,11 +285,30 @@ def make_delete_callback(i):
 for i in range(1, max_files+1):
     make_delete_callback(i)
 
+# 2θ range simulated when no scan is loaded.
+DEFAULT_TWO_THETA_RANGE = (10.0, 120.0)
+
+def zoom_range(relayout):
+    """
+    x range of the XRD plot from its relayoutData, or None when it is not
+    zoomed (or the event does not concern the x axis).
+    """
+    if not relayout:
+        return None
+    if "xaxis.range[0]" in relayout and "xaxis.range[1]" in relayout:
+        lo, hi = relayout["xaxis.range[0]"], relayout["xaxis.range[1]"]
+    elif "xaxis.range" in relayout:
+        lo, hi = relayout["xaxis.range"]
+    else:
+        return None
+    return (float(min(lo, hi)), float(max(lo, hi)))
+
 # ------------------------------------------------------------------
 # XRD Plot Callback (Using Dynamic Lattice Parameters and per-CIF intensity/background)
 # ------------------------------------------------------------------
 @app.callback(
-    Output("xrd-plot", "figure"),
+    [Output("xrd-plot", "figure"), Output("phase-positions", "data"), Output("xrd-window", "data")] +
+    [Output(f"fom-{i}", "children") for i in range(1, max_files+1)],
     [
         Input("xy-store", "data"),
         Input("opacity-slider", "value"),
@@ -290,10 +393,23 @@ for i in range(1, max_files+1):
         Input("background-5", "value"),
         Input("background-6", "value"),
         Input("background-7", "value"),
-        Input("background-8", "value")
+        Input("background-8", "value"),
+        # Particle sizes (empty: infinite crystal)
+        Input("particle-size-1", "value"),
+        Input("particle-size-2", "value"),
+        Input("particle-size-3", "value"),
+        Input("particle-size-4", "value"),
+        Input("particle-size-5", "value"),
+        Input("particle-size-6", "value"),
+        Input("particle-size-7", "value"),
+        Input("particle-size-8", "value"),
+        # Zooming out past the default range without a scan widens it.
+        Input("xrd-plot", "relayoutData")
     ],
-    State("cif-store", "data")
+    [State("cif-store", "data"),
+     State("xrd-window", "data")]
 )
+@profiled
 def update_xrd_plot(xy_data, opacity,
                     a1, a2, a3, a4, a5, a6, a7, a8,
                     b1, b2, b3, b4, b5, b6, b7, b8,
@@ -304,11 +420,44 @@ def update_xrd_plot(xy_data, opacity,
                     scale1, scale2, scale3, scale4, scale5, scale6, scale7, scale8,
                     intensity1, intensity2, intensity3, intensity4, intensity5, intensity6, intensity7, intensity8,
                     background1, background2, background3, background4, background5, background6, background7, background8,
-                    cif_data):
+                    size1, size2, size3, size4, size5, size6, size7, size8,
+                    relayout, cif_data, computed):
+    fom_outputs = [""] * max_files
     if cif_data is None:
-        return {}
+        return [{}, {}, None] + fom_outputs
+
+    exp_data = None
+    if xy_data:
+        try:
+            parsed_data = json.loads(xy_data)
+            exp_data = pd.DataFrame(parsed_data['data'], columns=parsed_data['columns'], index=parsed_data['index'])
+        except ValueError as e:
+            exp_data = None
+    if exp_data is not None and len(exp_data) == 0:
+        exp_data = None
+
+    # Patterns are only computed over the 2θ window of the loaded scan, or
+    # the default range widened to the current zoom when there is none.
+    if exp_data is not None:
+        window = (float(exp_data['2_theta'].min()), float(exp_data['2_theta'].max()))
+    else:
+        window = DEFAULT_TWO_THETA_RANGE
+        zoom = zoom_range(relayout)
+        if zoom is not None:
+            window = (max(0.0, min(window[0], zoom[0])), min(180.0, max(window[1], zoom[1])))
+    # Zoom and pan events only matter when they widen the range computed so
+    # far; with a scan loaded they never change the window.
+    if set(ctx.triggered_prop_ids) == {"xrd-plot.relayoutData"}:
+        if exp_data is not None or window == DEFAULT_TWO_THETA_RANGE:
+            raise PreventUpdate
+        if computed and computed[0] <= window[0] and window[1] <= computed[1]:
+            raise PreventUpdate
+
     patterns = []
     titles = []
+    scored = []
+    profiles = []
+    peak_positions = []
     file_names = sorted(cif_data.keys())
     num_files = len(file_names)
     a_vals = [a1, a2, a3, a4, a5, a6, a7, a8]
@@ -320,36 +469,40 @@ def update_xrd_plot(xy_data, opacity,
     scale_vals = [scale1, scale2, scale3, scale4, scale5, scale6, scale7, scale8]
     intensity_vals = [intensity1, intensity2, intensity3, intensity4, intensity5, intensity6, intensity7, intensity8]
     background_vals = [background1, background2, background3, background4, background5, background6, background7, background8]
+    size_vals = [size1, size2, size3, size4, size5, size6, size7, size8]
     
     for i in range(num_files):
         file_name = file_names[i]
         try:
-            structure = parse_cif(cif_data[file_name])
-            structure = normalize_structure(structure)
+            crystal = load_crystal(cif_data[file_name])
         except Exception as e:
             print("Error parsing CIF for", file_name, ":", e)
             continue
+        # The scale slider is looked up in a sweep computed once per cell.
+        parameters = (a_vals[i], b_vals[i], c_vals[i], alpha_vals[i], beta_vals[i], gamma_vals[i])
+        if None in parameters:
+            parameters = crystal.parameters
+        scale = scale_vals[i] if scale_vals[i] is not None else 0
         try:
-            scale_factor = 1 + (scale_vals[i] / 100) if scale_vals[i] is not None else 1
-            new_a = a_vals[i] * scale_factor
-            new_b = b_vals[i] * scale_factor
-            new_c = c_vals[i] * scale_factor
-            new_alpha = alpha_vals[i]
-            new_beta = beta_vals[i]
-            new_gamma = gamma_vals[i]
-            new_lattice = structure.lattice.from_parameters(new_a, new_b, new_c, new_alpha, new_beta, new_gamma)
-            new_structure = Structure(new_lattice, structure.species, structure.frac_coords)
-        except Exception as e:
-            print("Error updating lattice for", file_name, ":", e)
-            new_structure = structure
-
-        calculator = XRDCalculator(wavelength="CuKa")
-        try:
-            pattern = calculator.get_pattern(new_structure, two_theta_range=(10, 120))
+            if size_vals[i]:
+                # Finite particle: Debye profile on the scan's own grid.
+                grid = exp_data['2_theta'].to_numpy(dtype=float) if exp_data is not None else debye_grid(window)
+                pattern = load_debye(cif_data[file_name], parameters, size_vals[i], scale, grid)
+            else:
+                pattern = load_sweep(cif_data[file_name], parameters, two_theta_range=window, scale=scale).pattern(
+                    scale, two_theta_range=window)
         except Exception as e:
             print("Error in XRD calculation for", file_name, ":", e)
             continue
 
+        # Profiles are scored and marked by their peaks, like stick patterns.
+        if size_vals[i]:
+            peak_x, peak_y = pattern.peaks()
+            profiles.append(len(patterns))
+        else:
+            # Copies: the sliders below write into the pattern's arrays.
+            peak_x, peak_y = pattern.x.copy(), pattern.y.copy()
+
         # Work on a fresh copy of the original intensities.
         orig_y = list(pattern.y)
         # Apply intensity scaling (per CIF)
@@ -366,30 +519,97 @@ def update_xrd_plot(xy_data, opacity,
 
         patterns.append(pattern)
         titles.append(file_name)
-    
-    exp_data = None
-    if xy_data:
+        scored.append((i, peak_x, peak_y))
+        peak_positions.append(peak_x)
+
+    if exp_data is not None:
+        exp_x = exp_data['2_theta'].to_numpy()
+        exp_y = exp_data['intensity'].to_numpy()
+        exp_peaks = find_peaks(exp_x, exp_y)
+        for i, x, y in scored:
+            try:
+                fom_outputs[i] = format_score(score_pattern(x, y, exp_x, exp_y, exp_peaks=exp_peaks))
+            except Exception as e:
+                print("Error scoring", file_names[i], ":", e)
+
+    fig = plot_xrd(patterns, titles, "CuKa", experimental_data=exp_data, opacity=opacity, profiles=profiles)
+    # Keep the user's zoom across updates until a different scan is loaded.
+    fig.update_layout(uirevision=str(window) if exp_data is not None else "simulated")
+    positions = {title: [round(float(x), 3) for x in peak_x] for peak_x, title in zip(peak_positions, titles)}
+    return [fig, positions, list(window)] + fom_outputs
+
+# ------------------------------------------------------------------
+# Auto Scale Callback (phase scale factors and weight fractions)
+# ------------------------------------------------------------------
+LATTICE_FIELDS = ("a", "b", "c", "alpha", "beta", "gamma")
+
+@app.callback(
+    [Output(f"intensity-{i}", "value") for i in range(1, max_files+1)] +
+    [Output("phase-fractions", "children")],
+    Input("auto-scale", "n_clicks"),
+    [State("xy-store", "data"), State("cif-store", "data")] +
+    [State(f"lattice-{i}-{field}", "value") for field in LATTICE_FIELDS for i in range(1, max_files+1)] +
+    [State(f"lattice-scale-{i}", "value") for i in range(1, max_files+1)] +
+    [State(f"particle-size-{i}", "value") for i in range(1, max_files+1)],
+    prevent_initial_call=True
+)
+@profiled
+def auto_scale(n_clicks, xy_data, cif_data, *values):
+    intensities = [no_update] * max_files
+    if not xy_data or not cif_data:
+        return intensities + ["Load an .xy scan and at least one CIF first."]
+    try:
+        parsed_data = json.loads(xy_data)
+        exp_data = pd.DataFrame(parsed_data['data'], columns=parsed_data['columns'], index=parsed_data['index'])
+        exp_x = exp_data['2_theta'].to_numpy(dtype=float)
+        exp_y = exp_data['intensity'].to_numpy(dtype=float)
+    except (ValueError, KeyError) as e:
+        print("Error reading XY data for auto scale:", e)
+        return intensities + ["Could not read the .xy scan."]
+    lattice_vals = values[:len(LATTICE_FIELDS) * max_files]
+    scale_vals = values[len(LATTICE_FIELDS) * max_files:(len(LATTICE_FIELDS) + 1) * max_files]
+    size_vals = values[(len(LATTICE_FIELDS) + 1) * max_files:]
+
+    # Profiles are cached per phase state, so only edited phases are rebuilt.
+    blocks, names, profiles, raw_max, masses, volumes = [], [], [], [], [], []
+    for i, file_name in enumerate(sorted(cif_data.keys())[:max_files]):
         try:
-            parsed_data = json.loads(xy_data)
-            exp_data = pd.DataFrame(parsed_data['data'], columns=parsed_data['columns'], index=parsed_data['index'])
-        except ValueError as e:
-            exp_data = None
-    else:
-        exp_data = None
+            crystal = load_crystal(cif_data[file_name])
+            parameters = tuple(lattice_vals[f * max_files + i] for f in range(len(LATTICE_FIELDS)))
+            if None in parameters:
+                parameters = crystal.parameters
+            scale = scale_vals[i] if scale_vals[i] is not None else 0
+            if size_vals[i]:
+                debye_profile = load_debye(cif_data[file_name], parameters, size_vals[i], scale, exp_x)
+                profile, peak = debye_profile.y, debye_profile.raw_max
+            else:
+                profile, peak = load_profile(cif_data[file_name], parameters, scale, exp_x)
+        except Exception as e:
+            print("Error building profile for", file_name, ":", e)
+            continue
+        if peak <= 0:
+            continue
+        blocks.append(i)
+        names.append(file_name)
+        profiles.append(profile)
+        raw_max.append(peak)
+        masses.append(crystal.mass)
+        volumes.append(crystal.with_lattice(lattice_matrix(*parameters)).volume * (1 + scale / 100) ** 3)
+    if not profiles:
+        return intensities + ["No phase has peaks inside the scan range."]
 
-    fig = plot_xrd(patterns, titles, "CuKa", experimental_data=exp_data, opacity=opacity)
-    
-    max_y_list = [max(pattern.y) for pattern in patterns if pattern.y is not None and len(pattern.y) > 0]
-    max_y = max(max_y_list) if max_y_list else 100
-    fig.update_layout(
-        yaxis=dict(
-            range=[0, max(105, max_y + 5)],
-            dtick=10,
-            gridcolor='lightgray',
-            gridwidth=1
-        )
-    )
-    return fig
+    try:
+        scales, _ = fit_phase_scales(np.array(profiles), exp_y, exp_x)
+    except Exception as e:
+        print("Error fitting phase scales:", e)
+        return intensities + ["Phase scale fit failed."]
+    for i, s in zip(blocks, scales):
+        intensities[i] = int(np.clip(round(100 * s), 0, 100))
+    # Scales of the unnormalized patterns give Hill-Howard weight fractions.
+    fractions = weight_fractions(scales * 100 / np.array(raw_max), masses, volumes)
+    return intensities + ["Weight fractions: " + " · ".join(
+        f"{name} {100 * w:.1f}%" for name, w in zip(names, fractions)
+    )]
 
 # ------------------------------------------------------------------
 # Download Link Callback
@@ -398,6 +618,7 @@ def update_xrd_plot(xy_data, opacity,
     Output("download-link", "href"),
     Input("xrd-plot", "figure")
 )
+@profiled
 def update_download_link(figure):
     if not figure:
         return ""
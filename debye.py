@@ -0,0 +1,244 @@
+import os
+import numpy as np
+import scipy.fft
+from math import pi, degrees
+from functools import lru_cache
+from preprocess import (SCATTERING_COEFFS, SCATTERING_Z, WAVELENGTHS, PHASE_MEMORY_BUDGET, PHASE_THREADS,
+                        load_crystal, lattice_matrix, cell_key)
+from scoring import PROFILE_FWHM, find_peaks
+from cache import LRUCache, array_key
+
+# Width (angstroms) of the pair-distance histogram bins. Each bin is
+# evaluated at the mean distance of its pairs.
+DEBYE_BIN_WIDTH = 0.01
+# Largest cluster (atoms, occupancy-weighted) built for a Debye pattern.
+DEBYE_MAX_ATOMS = int(os.environ.get("XRD_DEBYE_MAX_ATOMS", 200000))
+# Step (degrees 2θ) of the grid used when there is no experimental scan.
+DEBYE_STEP = 0.02
+# Peaks of a particle of diameter D are at least the Scherrer width
+# 0.9 λ / D wide; profiles are computed at this many points per that width
+# and interpolated onto finer grids.
+DEBYE_SAMPLES_PER_WIDTH = 20
+
+class PairHistograms:
+    """
+    Pair-distance histograms of a finite spherical cluster, one per element
+    pair: ``counts[p, k]`` is the occupancy-weighted number of ordered atom
+    pairs of element pair ``pairs[p]`` (rows of SCATTERING_COEFFS, both
+    orders folded into one) in distance bin k, whose pairs lie at a mean
+    distance of ``distances[k]``. Bin 0 holds the self terms. ``cells`` is the number of unit cells' worth of atoms in the
+    cluster, which puts intensities on a per-cell scale.
+    """
+    __slots__ = ("pairs", "counts", "distances", "atoms", "cells", "volume")
+
+    def __init__(self, pairs, counts, distances, atoms, cells, volume):
+        self.pairs = pairs
+        self.counts = counts
+        self.distances = distances
+        self.atoms = atoms
+        self.cells = cells
+        self.volume = volume
+
+    def intensity(self, two_theta, wavelength="CuKa", factor=1.0):
+        """
+        Debye intensity per unit cell on the 2θ grid two_theta (degrees),
+        I(q) = sum_ab f_a f_b sum_r n_ab(r) sin(qr)/qr times the polarization
+        factor, for the cluster with all distances multiplied by factor.
+        """
+        wavelength = WAVELENGTHS.get(wavelength, wavelength)
+        theta = np.radians(np.asarray(two_theta, dtype=float)) / 2
+        s2 = (np.sin(theta) / wavelength) ** 2
+        q = 4 * pi * np.sin(theta) / wavelength
+        # Only distances that occur are evaluated.
+        occupied = np.flatnonzero(self.counts.any(axis=0))
+        r = self.distances[occupied] * factor
+        counts = self.counts[:, occupied]
+
+        elements = np.unique(self.pairs)
+        coeffs = SCATTERING_COEFFS[elements]
+        fs = SCATTERING_Z[elements] - 41.78214 * s2[:, None] * np.sum(
+            coeffs[:, :, 0] * np.exp(-coeffs[:, :, 1] * s2[:, None, None]),
+            axis=2
+        )
+        left = np.searchsorted(elements, self.pairs[:, 0])
+        right = np.searchsorted(elements, self.pairs[:, 1])
+
+        # sum_r n(r) sinc(qr) for all element pairs at once, in chunks of the
+        # grid sized to PHASE_MEMORY_BUDGET.
+        sums = np.empty((len(self.pairs), len(q)))
+        chunk = max(1, PHASE_MEMORY_BUDGET // (16 * max(len(r), 1)))
+        for start in range(0, len(q), chunk):
+            stop = min(start + chunk, len(q))
+            sums[:, start:stop] = counts @ np.sinc(np.outer(r, q[start:stop]) / pi)
+        intensity = np.sum(fs[:, left].T * fs[:, right].T * sums, axis=0)
+        polarization = (1 + np.cos(2 * theta) ** 2) / 2
+        return intensity * polarization / self.cells
+
+def _cluster_masks(crystal, diameter):
+    """
+    Unique sites (fractional coordinates) of crystal and, per site, a boolean
+    grid over lattice translations marking the copies that lie within a
+    sphere of the given diameter (angstroms) around the centre of cell 0.
+    """
+    sites, first = np.unique(crystal.site_idx, return_index=True)
+    frac = crystal.frac_coords[first]
+    radius = diameter / 2
+    # Spacing of the lattice planes normal to each reciprocal axis bounds the
+    # number of cells the sphere can reach along it.
+    spacings = 1 / np.linalg.norm(np.linalg.inv(crystal.matrix), axis=0)
+    reach = np.ceil(radius / spacings).astype(int) + 1
+    axes = [np.arange(-n, n + 1) for n in reach]
+    cells = np.stack(np.meshgrid(*axes, indexing="ij"), axis=-1) @ crystal.matrix
+    offsets = (frac - 0.5) @ crystal.matrix
+    masks = np.empty((len(sites),) + cells.shape[:3], dtype=bool)
+    for u, offset in enumerate(offsets):
+        masks[u] = np.sum((cells + offset) ** 2, axis=-1) <= radius ** 2
+    return frac, masks
+
+def pair_histograms(crystal, diameter, bin_width=DEBYE_BIN_WIDTH):
+    """
+    PairHistograms of a spherical cluster of the given diameter (angstroms)
+    cut from crystal, with mixed-occupancy sites weighted by occupancy.
+
+    Every atom of the cluster is a site u in some cell n, so the pairs of
+    sites (u, v) separated by lattice translation t number
+    sum_n M_u(n) M_v(n + t), a cross-correlation of the site masks done with
+    FFTs. The distances |t + x_v - x_u| are then computed (vectorized, in
+    chunks of sites sized to PHASE_MEMORY_BUDGET) once per (u, v, t) rather
+    than once per atom pair, and binned with bincount.
+    """
+    # Reject oversized clusters from the sphere volume before building masks.
+    estimate = pi / 6 * diameter ** 3 / crystal.volume * float(np.sum(crystal.occus))
+    if estimate > DEBYE_MAX_ATOMS:
+        raise ValueError(f"Cluster of about {estimate:.0f} atoms exceeds the limit of {DEBYE_MAX_ATOMS}")
+    frac, masks = _cluster_masks(crystal, diameter)
+    sites, site_rows = np.unique(crystal.site_idx, return_inverse=True)
+    elements, element_rows = np.unique(crystal.coeff_idx, return_inverse=True)
+    occupancy = np.zeros((len(sites), len(elements)))
+    np.add.at(occupancy, (site_rows, element_rows), crystal.occus)
+
+    inside = masks.reshape(len(sites), -1).sum(axis=1)
+    atoms = float(inside @ occupancy.sum(axis=1))
+    if atoms > DEBYE_MAX_ATOMS:
+        raise ValueError(f"Cluster of {atoms:.0f} atoms exceeds the limit of {DEBYE_MAX_ATOMS}")
+    cells = atoms / occupancy.sum()
+
+    # Correlations are linear (no wrap-around) on a grid of twice the size.
+    grid = masks.shape[1:]
+    padded = tuple(scipy.fft.next_fast_len(2 * n - 1, real=True) for n in grid)
+    spectra = scipy.fft.rfftn(masks.astype(float), s=padded, axes=(1, 2, 3), workers=PHASE_THREADS)
+    shifts = [np.where(np.arange(n) < g, np.arange(n), np.arange(n) - n) for n, g in zip(padded, grid)]
+    translations = np.stack(np.meshgrid(*shifts, indexing="ij"), axis=-1).reshape(-1, 3) @ crystal.matrix
+    size = len(translations)
+
+    bins = int(np.ceil(diameter / bin_width)) + 2
+    counts = np.zeros((len(elements), len(elements), bins))
+    # Pair numbers and summed distances per bin, for the mean distances.
+    numbers = np.zeros(bins)
+    moments = np.zeros(bins)
+    chunk = max(1, PHASE_MEMORY_BUDGET // (48 * size))
+    for u in range(len(sites)):
+        for start in range(0, len(sites), chunk):
+            v = np.arange(start, min(start + chunk, len(sites)))
+            pairs = scipy.fft.irfftn(spectra[u].conjugate() * spectra[v], s=padded, axes=(1, 2, 3),
+                                     workers=PHASE_THREADS)
+            pairs = np.rint(pairs.reshape(len(v), -1))
+            if u in v:
+                # The atom itself: a self term of occupancy weight, not occupancy squared.
+                self_count = pairs[u - start, 0]
+                pairs[u - start, 0] = 0
+                counts[:, :, 0] += np.diag(occupancy[u] * self_count)
+            which, where = np.nonzero(pairs > 0.5)
+            distance = np.linalg.norm(translations[where] + (frac[v[which]] - frac[u]) @ crystal.matrix, axis=1)
+            index = np.rint(distance / bin_width).astype(np.intp)
+            number = pairs[which, where]
+            # (site v x bin) histogram, then weighted by the element occupancies.
+            histogram = np.bincount(which * bins + index, weights=number, minlength=len(v) * bins)
+            histogram = histogram.reshape(len(v), bins)
+            counts += occupancy[u][:, None, None] * (occupancy[v].T @ histogram)
+            numbers += histogram.sum(axis=0)
+            moments += np.bincount(index, weights=number * distance, minlength=bins)
+
+    upper = np.triu_indices(len(elements))
+    folded = counts + counts.transpose(1, 0, 2)
+    folded[np.diag_indices(len(elements))] /= 2
+    distances = np.divide(moments, numbers, out=np.arange(bins) * bin_width, where=numbers > 0)
+    return PairHistograms(elements[np.stack(upper, axis=1)], folded[upper], distances, atoms, cells, crystal.volume)
+
+@lru_cache(maxsize=8)
+def load_histograms(contents, parameters, size):
+    """
+    PairHistograms of an uploaded .cif with its cell set to parameters, for
+    a particle of diameter size (nm). Cached per input; the lattice-scale
+    slider stretches the distances instead of rebuilding the cluster.
+    """
+    crystal = load_crystal(contents).with_lattice(lattice_matrix(*parameters))
+    return pair_histograms(crystal, 10 * float(size))
+
+def debye_grid(two_theta_range, step=DEBYE_STEP):
+    """
+    Uniform 2θ grid over two_theta_range, for plotting without a scan.
+    """
+    return np.arange(two_theta_range[0], two_theta_range[1] + step / 2, step)
+
+class DebyeProfile:
+    """
+    Debye pattern of a finite particle on a 2θ grid, with the intensity
+    scaled to a maximum of 100. raw_max converts back to the scale of the
+    stick patterns: it is the stick intensity whose PROFILE_FWHM Gaussian
+    encloses the same area as the per-cell profile at its maximum. width
+    is the Scherrer width (degrees 2θ), the narrowest its peaks can be.
+    """
+    __slots__ = ("x", "y", "raw_max", "width")
+
+    def __init__(self, x, y, raw_max, width):
+        self.x = x
+        self.y = y
+        self.raw_max = raw_max
+        self.width = width
+
+    def __len__(self):
+        return len(self.x)
+
+    def peaks(self):
+        """
+        Positions and heights of the profile's maxima, for scoring and
+        marking it like a stick pattern.
+        """
+        y = np.asarray(self.y, dtype=float)
+        x = find_peaks(self.x, y, tolerance=self.width / 2)
+        return x, np.interp(x, self.x, y)
+
+# Debye profiles, cached per phase state and grid.
+_debye_cache = LRUCache(max_items=32)
+
+def load_debye(contents, parameters, size, scale, two_theta, wavelength="CuKa"):
+    """
+    DebyeProfile of an uploaded .cif (cell set to parameters, shifted by
+    scale percent) as a particle of diameter size (nm), on the sorted 2θ
+    grid two_theta.
+    """
+    two_theta = np.asarray(two_theta, dtype=float)
+    parameters = cell_key(parameters)
+    key = (contents, parameters, float(size), float(scale), wavelength, array_key(two_theta))
+    cached = _debye_cache.get(key)
+    if cached is not None:
+        return DebyeProfile(cached.x, cached.y, cached.raw_max, cached.width)
+    histograms = load_histograms(contents, parameters, float(size))
+    factor = 1 + scale / 100
+    lam = WAVELENGTHS.get(wavelength, wavelength)
+    width = degrees(0.9 * lam / (10 * float(size)))
+    step = width / DEBYE_SAMPLES_PER_WIDTH
+    if len(two_theta) > 1 and (two_theta[-1] - two_theta[0]) / step < len(two_theta):
+        samples = np.append(np.arange(two_theta[0], two_theta[-1], step), two_theta[-1])
+        raw = np.interp(two_theta, samples, histograms.intensity(samples, wavelength, factor))
+    else:
+        raw = histograms.intensity(two_theta, wavelength, factor)
+    peak = float(raw.max()) if len(raw) else 0.0
+    # A Bragg peak of stick intensity I integrates (over 2θ in degrees) to
+    # I * 180 λ³ / (32 π² V) in the per-cell Debye intensity.
+    per_stick = 180 * lam ** 3 / (32 * pi ** 2 * histograms.volume * factor ** 3)
+    gaussian_area = PROFILE_FWHM * np.sqrt(pi / (4 * np.log(2)))
+    cached = DebyeProfile(two_theta, raw * (100 / peak) if peak > 0 else raw, peak * gaussian_area / per_stick, width)
+    _debye_cache.put(key, cached)
+    return DebyeProfile(cached.x, cached.y, cached.raw_max, cached.width)
@@ -221,7 +221,28 @@ for i in range(1, max_files + 1):
                         tooltip={"placement": "bottom", "always_visible": True}
                     )
                 ], style={"flex": "1 1 200px", "marginRight": "5px", "fontSize": "14px"})
-            ], style={"display": "flex", "flexWrap": "wrap", "gap": "5px"})
+            ], style={"display": "flex", "flexWrap": "wrap", "gap": "5px"}),
+            # Particle size: empty for an infinite crystal (sticks), else a
+            # size-broadened Debye pattern of a spherical particle.
+            html.Div([
+                html.Label("Particle size (nm):", style={"fontSize": "14px"}),
+                dcc.Input(
+                    id=f"particle-size-{i}",
+                    type="number",
+                    min=1,
+                    max=50,
+                    debounce=True,
+                    placeholder="bulk",
+                    style={
+                        "width": "60px",
+                        "height": "24px",
+                        "fontSize": "14px",
+                        "margin": "5px"
+                    }
+                )
+            ], style={"display": "flex", "alignItems": "center", "justifyContent": "center", "fontSize": "14px"}),
+            # Live figures of merit against the experimental data
+            html.Div(id=f"fom-{i}", style={"fontSize": "14px", "marginTop": "5px", "textAlign": "center"})
         ]
     )
     lattice_params_blocks.append(block)
@@ -270,6 +291,20 @@ app.layout = html.Div(
                         }
                     ),
                     style={"width": "10%", "display": "inline-block", "verticalAlign": "middle"}
+                ),
+                # Optional preprocessing of the experimental data.
+                dcc.Checklist(
+                    id="xy-options",
+                    options=[
+                        {"label": "Subtract background", "value": "background"},
+                        {"label": "Smooth", "value": "smooth"},
+                        {"label": "Strip Kα2", "value": "kalpha2"}
+                    ],
+                    value=[],
+                    inline=True,
+                    inputStyle={"marginRight": "5px"},
+                    labelStyle={"marginRight": "20px"},
+                    style={"fontSize": "16px", "textAlign": "center"}
                 )
             ], style={"width": "50%", "display": "inline-block"}),
             # CIF file upload container.
@@ -342,15 +377,89 @@ app.layout = html.Div(
                 download="xrd_pattern.png",
                 href="",
                 target="_blank"
-            )
-        ], style={"marginTop": "10px", "marginBottom": "10px"}),
+            ),
+            # Fit the intensity sliders to the experimental data.
+            html.Button("Auto scale", id="auto-scale", n_clicks=0, style={
+                "margin-left": "10px",
+                "padding": "9px 18px",
+                "backgroundColor": "#2196F3",
+                "color": "white",
+                "border": "none",
+                "borderRadius": "4px",
+                "cursor": "pointer",
+                "fontSize": "20px"
+            }),
+            html.Span(id="phase-fractions", style={"marginLeft": "15px", "fontSize": "18px"})
+        ], style={"marginTop": "10px", "marginBottom": "10px", "display": "flex", "alignItems": "center"}),
         # XRD Plot.
         html.Div([
             dcc.Graph(id="xrd-plot")
         ], id="plot-container", style={"width": "100%", "height": "1000px"}),
+        # Scan series (in-situ / temperature series) section.
+        html.Div([
+            html.Div([
+                html.Div(
+                    dcc.Upload(
+                        id="upload-xy-series",
+                        children=html.Div("Drop a series of .xy files or click to select"),
+                        multiple=True,
+                        accept=".xy",
+                        style=upload_style
+                    ),
+                    style={"width": "90%", "display": "inline-block", "verticalAlign": "top"}
+                ),
+                html.Div(
+                    html.Span(
+                        id="series-upload-status",
+                        style={
+                            "margin-left": "10px",
+                            "color": "green",
+                            "fontSize": "24px",
+                            "position": "relative",
+                            "textAlign": "center",
+                            "left": "20px",
+                            "top": "20px"
+                        }
+                    ),
+                    style={"width": "10%", "display": "inline-block", "verticalAlign": "middle"}
+                )
+            ], style={"width": "50%", "display": "inline-block"}),
+            html.Div([
+                dcc.RadioItems(
+                    id="series-mode",
+                    options=[
+                        {"label": "Heatmap", "value": "heatmap"},
+                        {"label": "Waterfall", "value": "waterfall"}
+                    ],
+                    value="heatmap",
+                    inline=True,
+                    inputStyle={"marginRight": "5px"},
+                    labelStyle={"marginRight": "20px"}
+                ),
+                html.Label("Scan shown in the main plot:", style={"fontSize": "14px"}),
+                dcc.Slider(
+                    id="series-index",
+                    min=0,
+                    max=0,
+                    step=1,
+                    value=0,
+                    marks=None,
+                    tooltip={"placement": "bottom", "always_visible": True}
+                )
+            ], style={"width": "45%", "display": "inline-block", "verticalAlign": "top", "fontSize": "18px"})
+        ], style={"display": "flex", "width": "100%", "marginTop": "20px"}),
+        html.Div([
+            dcc.Graph(id="series-plot")
+        ], id="series-container", style={"width": "100%", "height": "800px"}),
         # Hidden data stores.
         dcc.Store(id="cif-store"),
-        dcc.Store(id="xy-store")
+        dcc.Store(id="xy-store"),
+        # Where the shown scan comes from: "upload" or "series".
+        dcc.Store(id="xy-source"),
+        dcc.Store(id="series-store"),
+        dcc.Store(id="phase-positions"),
+        # 2θ window the XRD plot was last computed over.
+        dcc.Store(id="xrd-window")
     ]
 )
 
@@ -0,0 +1,338 @@
+"""
+Load test for the Dash app: starts `gunicorn app:server` with each worker
+configuration, replays scripted sessions (upload CIFs and a scan, drag the
+sliders, edit lattice fields; every figure update also regenerates the
+image download link) from concurrent virtual users through
+/_dash-update-component, and reports per-callback latency percentiles,
+throughput and worker memory.
+
+    python loadtest.py --cif a.cif b.cif --xy scan.xy --workers 1 2 4 --threads 1 4 --concurrency 1 4 16
+"""
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+import threading
+import subprocess
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+LOADTEST_PORT = 8765
+STARTUP_TIMEOUT = 120
+REQUEST_TIMEOUT = 300
+# Callbacks triggered by outputs of other callbacks are followed this deep.
+MAX_CHAIN = 6
+RSS_INTERVAL = 0.5
+
+def data_url(path):
+    """
+    File contents in the data-URL form dcc.Upload sends.
+    """
+    with open(path, "rb") as f:
+        return "data:application/octet-stream;base64," + base64.b64encode(f.read()).decode("ascii")
+
+def split_output(output):
+    """
+    (id, property) pairs of a dependency's output string, without the
+    allow_duplicate suffix.
+    """
+    parts = output[2:-2].split("...") if output.startswith("..") else [output]
+    return [tuple(part.split("@")[0].rsplit(".", 1)) for part in parts]
+
+def layout_values(node, values=None):
+    """
+    Initial (id, property) -> value map of every component in a layout.
+    """
+    if values is None:
+        values = {}
+    if isinstance(node, list):
+        for child in node:
+            layout_values(child, values)
+    elif isinstance(node, dict) and "props" in node:
+        props = node["props"]
+        if "id" in props:
+            for prop, value in props.items():
+                values[(props["id"], prop)] = value
+        layout_values(props.get("children"), values)
+    return values
+
+def get_json(url):
+    with urllib.request.urlopen(url, timeout=REQUEST_TIMEOUT) as response:
+        return json.load(response)
+
+class Stats:
+    """
+    Thread-safe latency samples (seconds) and error counts per callback.
+    """
+    def __init__(self):
+        self.latency = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def add(self, label, seconds, error=False):
+        with self.lock:
+            self.latency.setdefault(label, []).append(seconds)
+            if error:
+                self.errors[label] = self.errors.get(label, 0) + 1
+
+class Session:
+    """
+    One virtual browser: holds the client-side component state and fires
+    callbacks the way the Dash renderer does when props change.
+    """
+    def __init__(self, url, dependencies, values, stats):
+        self.url = url
+        self.dependencies = dependencies
+        self.values = dict(values)
+        self.stats = stats
+
+    def fire(self, dep, changed):
+        """
+        POST one callback; applies its outputs and returns the changed keys.
+        """
+        outputs = [{"id": i, "property": p} for i, p in split_output(dep["output"])]
+        body = {
+            "output": dep["output"],
+            "outputs": outputs if dep["output"].startswith("..") else outputs[0],
+            "inputs": [dict(d, value=self.values.get((d["id"], d["property"]))) for d in dep["inputs"]],
+            "state": [dict(d, value=self.values.get((d["id"], d["property"]))) for d in dep["state"]],
+            "changedPropIds": [f"{i}.{p}" for i, p in changed],
+        }
+        request = urllib.request.Request(
+            self.url + "/_dash-update-component", data=json.dumps(body).encode(),
+            headers={"Content-Type": "application/json"}
+        )
+        # Several callbacks write the same store, so the first input is part of the label.
+        label = "{}.{}".format(*outputs[0].values()) + (f" (+{len(outputs) - 1})" if len(outputs) > 1 else "")
+        if dep["inputs"]:
+            label += " <- {id}.{property}".format(**dep["inputs"][0])
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT) as response:
+                payload = response.read()
+                status = response.status
+        except (urllib.error.URLError, OSError):
+            self.stats.add(label, time.perf_counter() - start, error=True)
+            return []
+        self.stats.add(label, time.perf_counter() - start)
+        if status == 204 or not payload:
+            return []
+        updated = []
+        for component_id, props in json.loads(payload).get("response", {}).items():
+            for prop, value in props.items():
+                # Patches are applied in the browser; the state keeps the last full value.
+                if isinstance(value, dict) and "__dash_patch_update" in value:
+                    continue
+                self.values[(component_id, prop)] = value
+                updated.append((component_id, prop))
+        return updated
+
+    def load(self):
+        """
+        Page load: every callback without prevent_initial_call fires once.
+        """
+        for dep in self.dependencies:
+            if not dep.get("prevent_initial_call"):
+                self.fire(dep, [])
+
+    def set(self, changes):
+        """
+        Change component props as a user would and follow the callback chain.
+        """
+        self.values.update(changes)
+        pending = set(changes)
+        for _ in range(MAX_CHAIN):
+            updated = set()
+            for dep in self.dependencies:
+                changed = [key for key in ((d["id"], d["property"]) for d in dep["inputs"]) if key in pending]
+                if changed:
+                    updated.update(self.fire(dep, changed))
+            if not updated:
+                break
+            pending = updated
+
+def run_session(session, cifs, xy):
+    """
+    The scripted session replayed by every virtual user.
+    """
+    session.load()
+    session.set({("upload-cif", "contents"): [data_url(p) for p in cifs],
+                 ("upload-cif", "filename"): [os.path.basename(p) for p in cifs]})
+    if xy:
+        session.set({("upload-xy", "contents"): data_url(xy), ("upload-xy", "filename"): os.path.basename(xy)})
+    for value in (-1.0, -0.5, 0.5, 1.0, 0):
+        session.set({("lattice-scale-1", "value"): value})
+    for value in (80, 60, 100):
+        session.set({("intensity-1", "value"): value})
+    a = session.values.get(("lattice-1-a", "value"))
+    if a is not None:
+        for value in (round(a * 1.01, 4), a):
+            session.set({("lattice-1-a", "value"): value})
+
+def process_rss(pid):
+    """
+    Resident set size (bytes) of a process, 0 if it is gone.
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+def child_pids(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+class RssSampler(threading.Thread):
+    """
+    Samples the RSS of the gunicorn master and its workers until stopped;
+    keeps the peak total and the peak of any single worker.
+    """
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.peak_total = 0
+        self.peak_worker = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            workers = [process_rss(p) for p in child_pids(self.pid)]
+            self.peak_total = max(self.peak_total, process_rss(self.pid) + sum(workers))
+            self.peak_worker = max([self.peak_worker] + workers)
+            self.stopped.wait(RSS_INTERVAL)
+
+def start_server(workers, threads, port):
+    """
+    Start gunicorn with the given configuration and wait until it serves.
+    """
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "app:server", "--bind", f"127.0.0.1:{port}",
+         "--workers", str(workers), "--threads", str(threads), "--timeout", str(REQUEST_TIMEOUT)],
+        cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with code {proc.returncode}")
+        try:
+            get_json(f"http://127.0.0.1:{port}/_dash-layout")
+            return proc
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.5)
+    proc.terminate()
+    raise RuntimeError("gunicorn did not start in time")
+
+def run_level(url, concurrency, sessions, cifs, xy, pid=None):
+    """
+    Run concurrency virtual users, each replaying sessions sessions; returns
+    the latency stats, the wall time and the RSS sampler (None without pid).
+    """
+    dependencies = get_json(url + "/_dash-dependencies")
+    values = layout_values(get_json(url + "/_dash-layout"))
+    stats = Stats()
+    sampler = RssSampler(pid) if pid else None
+    if sampler:
+        sampler.start()
+
+    def user(_):
+        for _ in range(sessions):
+            run_session(Session(url, dependencies, values, stats), cifs, xy)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(user, range(concurrency)))
+    elapsed = time.perf_counter() - start
+    if sampler:
+        sampler.stopped.set()
+        sampler.join()
+    return stats, elapsed, sampler
+
+def summarize(stats, elapsed, sampler, concurrency, sessions):
+    """
+    Result of one level as a JSON-ready dict.
+    """
+    callbacks = {}
+    for label, samples in sorted(stats.latency.items()):
+        p50, p95, p99 = np.percentile(np.array(samples) * 1000, [50, 95, 99])
+        callbacks[label] = {"count": len(samples), "errors": stats.errors.get(label, 0),
+                            "p50_ms": round(p50, 1), "p95_ms": round(p95, 1), "p99_ms": round(p99, 1)}
+    requests = sum(len(s) for s in stats.latency.values())
+    result = {
+        "concurrency": concurrency,
+        "sessions": concurrency * sessions,
+        "requests": requests,
+        "elapsed_s": round(elapsed, 2),
+        "requests_per_s": round(requests / elapsed, 2),
+        "sessions_per_min": round(60 * concurrency * sessions / elapsed, 2),
+        "callbacks": callbacks,
+    }
+    if sampler:
+        result["peak_rss_mb"] = round(sampler.peak_total / 1024 ** 2, 1)
+        result["peak_worker_rss_mb"] = round(sampler.peak_worker / 1024 ** 2, 1)
+    return result
+
+def print_result(config, result):
+    print(f"\n== {config} | concurrency {result['concurrency']}: {result['requests']} requests in "
+          f"{result['elapsed_s']} s, {result['requests_per_s']} req/s, {result['sessions_per_min']} sessions/min")
+    if "peak_rss_mb" in result:
+        print(f"   peak RSS {result['peak_rss_mb']} MB total, {result['peak_worker_rss_mb']} MB per worker")
+    print(f"   {'callback':<60} {'count':>6} {'err':>4} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for label, row in result["callbacks"].items():
+        print(f"   {label[:60]:<60} {row['count']:>6} {row['errors']:>4} "
+              f"{row['p50_ms']:>9} {row['p95_ms']:>9} {row['p99_ms']:>9}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the XRD app with scripted concurrent sessions.")
+    parser.add_argument("--cif", nargs="+", required=True, help="CIF files uploaded in each session")
+    parser.add_argument("--xy", help=".xy scan uploaded in each session")
+    parser.add_argument("--workers", nargs="+", type=int, default=[1], help="gunicorn worker counts to test")
+    parser.add_argument("--threads", nargs="+", type=int, default=[1], help="gunicorn threads per worker to test")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4, 16], help="simultaneous users")
+    parser.add_argument("--sessions", type=int, default=2, help="sessions replayed by each user")
+    parser.add_argument("--url", help="test an already running server instead of starting gunicorn")
+    parser.add_argument("--port", type=int, default=LOADTEST_PORT)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    if args.url:
+        configs = [(args.url, None)]
+    else:
+        configs = [(w, t) for w in args.workers for t in args.threads]
+    for config in configs:
+        proc = None
+        if args.url:
+            url, name = args.url.rstrip("/"), args.url
+        else:
+            workers, threads = config
+            name = f"workers={workers} threads={threads}"
+            proc = start_server(workers, threads, args.port)
+            url = f"http://127.0.0.1:{args.port}"
+        try:
+            for concurrency in args.concurrency:
+                stats, elapsed, sampler = run_level(url, concurrency, args.sessions, args.cif, args.xy,
+                                                    pid=proc.pid if proc else None)
+                result = dict(summarize(stats, elapsed, sampler, concurrency, args.sessions), server=name)
+                print_result(name, result)
+                results.append(result)
+        finally:
+            if proc:
+                proc.terminate()
+                proc.wait()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -1,76 +1,204 @@
-import math
+import numpy as np
 import plotly.graph_objects as go
-import plotly.io as pio
 
-def plot_xrd(patterns, titles, wavelength, experimental_data=None, opacity=0.9):
+# Phase colors (plotly's default qualitative palette), set explicitly so the
+# figure does not need to carry a full template.
+PHASE_COLORS = ["#636EFA", "#EF553B", "#00CC96", "#AB63FA", "#FFA15A",
+                "#19D3F3", "#FF6692", "#B6E880", "#FF97FF", "#FECB52"]
+
+def compact(values, decimals):
+    """
+    Round values and store them as float32, which plotly serializes as a
+    base64 typed array instead of a list of full-precision floats.
+    """
+    return np.round(np.asarray(values, dtype=float), decimals).astype(np.float32)
+
+def axis_arrays(two_theta):
+    """
+    x encoding of a scan: x0/dx when the steps are uniform, else a typed array.
+    """
+    two_theta = np.asarray(two_theta, dtype=float)
+    steps = np.diff(two_theta)
+    if len(steps) and np.allclose(steps, steps[0], rtol=0, atol=1e-6):
+        return dict(x0=float(two_theta[0]), dx=float(steps[0]))
+    return dict(x=compact(two_theta, 3))
+
+def stick_arrays(x_vals, y_vals):
+    """
+    Encode a stick pattern as one polyline: (x, 0) -> (x, y) for every peak,
+    separated by NaN gaps.
+    """
+    n = len(x_vals)
+    x = np.full(3 * n, np.nan)
+    y = np.full(3 * n, np.nan)
+    x[0::3] = x_vals
+    x[1::3] = x_vals
+    y[0::3] = 0
+    y[1::3] = y_vals
+    return compact(x, 3), compact(y, 2)
+
+# Size limits of the series heatmap and number of scans in the waterfall.
+SERIES_MAX_ROWS = 300
+SERIES_MAX_COLUMNS = 1000
+WATERFALL_MAX_SCANS = 40
+WATERFALL_OFFSET = 20
+
+def downsample(data, max_rows, max_columns):
     """
-    Generate a Plotly figure of XRD patterns.
+    Max-pool a (scan x point) array so it has at most max_rows x max_columns
+    cells; returns the pooled array and the (row, column) pooling factors.
     """
-    
+    n_rows, n_cols = data.shape
+    fr = int(np.ceil(n_rows / max_rows))
+    fc = int(np.ceil(n_cols / max_columns))
+    rows = []
+    for start in range(0, n_rows, fr):
+        block = np.asarray(data[start:start + fr], dtype=np.float32)
+        pooled = np.pad(np.fmax.reduce(block, axis=0), (0, -n_cols % fc), constant_values=np.nan)
+        rows.append(np.fmax.reduce(pooled.reshape(-1, fc), axis=1))
+    return np.array(rows, dtype=np.float32), (fr, fc)
+
+def series_extent(count, mode):
+    """
+    y range covered by a series plot with count scans.
+    """
+    if mode == "waterfall":
+        return 0, 100 + WATERFALL_OFFSET * (min(count, WATERFALL_MAX_SCANS) - 1)
+    return -0.5, count - 0.5
+
+def series_marker(index, count, mode, x_range):
+    """
+    Trace marking the scan currently shown in the main plot.
+    """
+    if mode == "waterfall":
+        offset = WATERFALL_OFFSET * index * (min(count, WATERFALL_MAX_SCANS) - 1) / max(count - 1, 1)
+        x, y = [x_range[0], x_range[1]], [offset, offset]
+    else:
+        x, y = [x_range[0], x_range[1]], [index, index]
+    return go.Scatter(x=x, y=y, mode='lines', name=f"Scan {index}", line=dict(color='red', width=2, dash='dash'),
+                      showlegend=False, hoverinfo='skip')
+
+def series_overlay(positions, count, mode, slots):
+    """
+    One trace per phase slot marking simulated peak positions as vertical
+    lines across the series plot; unused slots are empty.
+    """
+    y0, y1 = series_extent(count, mode)
+    traces = []
+    items = list(positions.items())
+    for k in range(slots):
+        title, x_vals = items[k] if k < len(items) else ("", [])
+        n = len(x_vals)
+        x = np.full(3 * n, np.nan)
+        y = np.full(3 * n, np.nan)
+        x[0::3] = x_vals
+        x[1::3] = x_vals
+        y[0::3] = y0
+        y[1::3] = y1
+        traces.append(go.Scatter(
+            x=compact(x, 3), y=compact(y, 2), mode='lines', name=title, showlegend=bool(n),
+            line=dict(width=1, color=PHASE_COLORS[k % len(PHASE_COLORS)]), opacity=0.7, hoverinfo='skip'
+        ))
+    return traces
+
+def plot_series(grid, data, index, positions, mode="heatmap", slots=8):
+    """
+    Generate a Plotly figure of a scan series (grid: shared 2θ grid, data:
+    scan x point array), as a max-pooled heatmap or a waterfall of evenly
+    spaced scans, with simulated peak positions overlaid. The traces are
+    always [series, current-scan marker, phase slot 1..slots], so callers
+    can patch the marker and overlay without resending the series.
+    """
+    count = data.shape[0]
+    step = grid[1] - grid[0] if len(grid) > 1 else 1.0
+    fig = go.Figure()
+    if mode == "waterfall":
+        shown = np.unique(np.linspace(0, count - 1, min(count, WATERFALL_MAX_SCANS)).round().astype(int))
+        pooled, (_, fc) = downsample(data[shown], len(shown), SERIES_MAX_COLUMNS)
+        x = grid[0] + (np.arange(pooled.shape[1]) * fc + (fc - 1) / 2) * step
+        rows = pooled + WATERFALL_OFFSET * np.arange(len(shown))[:, None]
+        gaps = np.full((len(shown), 1), np.nan)
+        fig.add_trace(go.Scatter(
+            x=compact(np.tile(np.append(x, np.nan), len(shown)), 3),
+            y=compact(np.hstack((rows, gaps)).ravel(), 2),
+            mode='lines', name='Scans', line=dict(color='black', width=1), showlegend=False
+        ))
+    else:
+        pooled, (fr, fc) = downsample(data, SERIES_MAX_ROWS, SERIES_MAX_COLUMNS)
+        fig.add_trace(go.Heatmap(
+            z=compact(pooled, 2),
+            x0=float(grid[0] + (fc - 1) / 2 * step), dx=float(fc * step),
+            y0=(fr - 1) / 2, dy=fr,
+            colorscale='Viridis', colorbar=dict(title="intensity"), name='Scans'
+        ))
+    x_range = [float(grid[0]), float(grid[-1])]
+    fig.add_trace(series_marker(index, count, mode, x_range))
+    fig.add_traces(series_overlay(positions, count, mode, slots))
+
+    y0, y1 = series_extent(count, mode)
+    fig.update_layout(
+        font=dict(family="Microsoft Sans Serif", size=18, color="black"),
+        xaxis=dict(title=dict(text="diffraction angle, 2<i>θ</i>"), range=x_range, tick0=0, dtick=10,
+                   ticks="inside", minor=dict(dtick=1, ticks="inside"), zeroline=False),
+        yaxis=dict(title=dict(text="intensity (offset)" if mode == "waterfall" else "scan"),
+                   range=[y0, y1], zeroline=False),
+        template="none",
+        plot_bgcolor='white',
+        paper_bgcolor='white',
+        legend=dict(orientation='h', y=1.05)
+    )
+    return fig
+
+def plot_xrd(patterns, titles, wavelength, experimental_data=None, opacity=0.9, profiles=()):
+    """
+    Generate a Plotly figure of XRD patterns. Patterns whose index is in
+    profiles are continuous profiles (drawn as lines), the rest sticks.
+    """
+
     def extract_xy(pattern):
         try:
-            return pattern.x, pattern.y
+            return np.asarray(pattern.x, dtype=float), np.asarray(pattern.y, dtype=float)
         except AttributeError:
-            x_vals = [row[0] for row in pattern]
-            y_vals = [row[1] for row in pattern]
+            x_vals = np.array([row[0] for row in pattern], dtype=float)
+            y_vals = np.array([row[1] for row in pattern], dtype=float)
             return x_vals, y_vals
 
     fig = go.Figure()
+    pattern_xy = [extract_xy(pattern) for pattern in patterns]
 
     # Determine the x-axis range.
     if experimental_data is not None:
         x_min = experimental_data['2_theta'].min()
         x_max = experimental_data['2_theta'].max()
         fig.add_trace(go.Scatter(
-            x=experimental_data['2_theta'], 
-            y=experimental_data['intensity'],
-            mode='lines', 
+            **axis_arrays(experimental_data['2_theta']),
+            y=compact(experimental_data['intensity'], 2),
+            mode='lines',
             name='Experimental data',
             line=dict(color='black', width=1)
         ))
     else:
-        x_min = min(min(extract_xy(pattern)[0]) for pattern in patterns)
-        x_max = max(max(extract_xy(pattern)[0]) for pattern in patterns)
-
-    for pattern, title in zip(patterns, titles):
-        x_vals, y_vals = extract_xy(pattern)
-        valid_indices = [i for i, x_val in enumerate(x_vals) if x_min <= x_val <= x_max]
-        fig.add_trace(go.Bar(
-            x=[x_vals[i] for i in valid_indices],
-            y=[y_vals[i] for i in valid_indices],
+        x_min = min(x_vals.min() for x_vals, _ in pattern_xy)
+        x_max = max(x_vals.max() for x_vals, _ in pattern_xy)
+
+    max_y = 100
+    for k, ((x_vals, y_vals), title) in enumerate(zip(pattern_xy, titles)):
+        valid = (x_vals >= x_min) & (x_vals <= x_max)
+        if k in profiles:
+            xy = dict(axis_arrays(x_vals[valid]), y=compact(y_vals[valid], 2))
+        else:
+            stick_x, stick_y = stick_arrays(x_vals[valid], y_vals[valid])
+            xy = dict(x=stick_x, y=stick_y)
+        if valid.any():
+            max_y = max(max_y, y_vals[valid].max())
+        fig.add_trace(go.Scatter(
+            **xy,
+            mode='lines',
             name=title,
-            width=0.15,
+            line=dict(width=2, color=PHASE_COLORS[k % len(PHASE_COLORS)]),
             opacity=opacity
         ))
 
-    x_lower = int(math.floor(x_min))
-    x_upper = int(math.ceil(x_max))
-    big_ticks = [x for x in range(x_lower, x_upper + 1) if x % 10 == 0]
-
-    tick_shapes = []
-    for x in range(x_lower, x_upper + 1):
-        if x % 10 == 0:
-            tick_length = 0.04
-            tick_color = 'black'
-            tick_width = 2
-        elif x % 5 == 0:
-            tick_length = 0.03
-            tick_color = 'grey'
-            tick_width = 1.5
-        else:
-            tick_length = 0.02
-            tick_color = 'grey'
-            tick_width = 1
-        tick_shapes.append(
-            dict(
-                type="line",
-                xref="x", yref="paper",
-                x0=x, x1=x,
-                y0=0, y1=tick_length,
-                line=dict(color=tick_color, width=tick_width)
-            )
-        )
-
     # Explicitly set the font to "Microsoft Sans Serif" and apply it throughout
     fig.update_layout(
         title=dict(
@@ -80,29 +208,32 @@ def plot_xrd(patterns, titles, wavelength, experimental_data=None, opacity=0.9):
         font=dict(family="Microsoft Sans Serif", size=24, color="black"),
         xaxis=dict(
             title=dict(text="diffraction angle, 2<i>θ</i>", font=dict(family="Microsoft Sans Serif", size=24)),
-            range=[x_min, x_max],
-            tickmode='array',
-            tickvals=big_ticks,
-            ticktext=[str(t) for t in big_ticks],
-            ticks="",
+            range=[float(x_min), float(x_max)],
+            tick0=0,
+            dtick=10,
+            ticks="inside",
+            ticklen=16,
+            tickwidth=2,
+            tickcolor='black',
+            minor=dict(dtick=1, ticks="inside", ticklen=8, tickwidth=1, tickcolor='grey', showgrid=False),
             gridcolor='lightgray',
             gridwidth=1,
             zeroline=False
         ),
         yaxis=dict(
             title=dict(text="intensity, a.u.", font=dict(family="Microsoft Sans Serif", size=24)),
-            range=[0, 105],
+            range=[0, max(105, float(max_y) + 5)],
+            dtick=10,
             gridcolor='lightgray',
             gridwidth=1,
+            zeroline=False,
             tickfont=dict(family="Microsoft Sans Serif", size=24)
         ),
-        shapes=tick_shapes,
-        template="plotly_white",
-        barmode='overlay',
-        plot_bgcolor='white'
+        template="none",
+        colorway=PHASE_COLORS,
+        hovermode='closest',
+        plot_bgcolor='white',
+        paper_bgcolor='white'
     )
 
-    # Save the plot as an image using Kaleido engine without `config` argument
-    pio.write_image(fig, 'xrd_pattern.png', engine="kaleido")
-    
     return fig
@@ -1,14 +1,23 @@
 import os
+import re
+import glob
+import copy
 import json
 import base64
 import numpy as np
 import pandas as pd
-from math import sin, radians, asin, degrees, pi, cos
+from math import sin, radians, degrees, pi
 from io import StringIO
-from pymatgen.core import Structure
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from pymatgen.core import Element, Structure
 from pymatgen.io.cif import CifParser
 from pymatgen.analysis.diffraction.core import AbstractDiffractionPatternCalculator, DiffractionPattern, get_unique_families
 from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+from scoring import stick_profile
+import store
+from cache import LRUCache, array_key
+from profiling import attributed
 
 # XRD wavelengths in angstroms.
 WAVELENGTHS = {
@@ -24,6 +33,191 @@ if not os.path.exists(atomic_scattering_params_path):
 with open(atomic_scattering_params_path) as file:
     ATOMIC_SCATTERING_PARAMS = json.load(file)
 
+# Scattering coefficients as arrays; Crystal.coeff_idx indexes rows of these.
+SCATTERING_SYMBOLS = tuple(ATOMIC_SCATTERING_PARAMS)
+SCATTERING_INDEX = {symbol: i for i, symbol in enumerate(SCATTERING_SYMBOLS)}
+SCATTERING_COEFFS = np.array([ATOMIC_SCATTERING_PARAMS[s] for s in SCATTERING_SYMBOLS], dtype=float)
+SCATTERING_Z = np.array([Element(s).Z for s in SCATTERING_SYMBOLS], dtype=float)
+
+def lattice_matrix(a, b, c, alpha, beta, gamma):
+    """
+    Build a 3x3 lattice matrix (rows are a, b, c) from cell parameters,
+    using the same orientation convention as pymatgen's Lattice.from_parameters.
+    """
+    alpha_r, beta_r, gamma_r = np.radians([alpha, beta, gamma])
+    val = (np.cos(alpha_r) * np.cos(beta_r) - np.cos(gamma_r)) / (np.sin(alpha_r) * np.sin(beta_r))
+    gamma_star = np.arccos(np.clip(val, -1, 1))
+    return np.array([
+        [a * np.sin(beta_r), 0.0, a * np.cos(beta_r)],
+        [-b * np.sin(alpha_r) * np.cos(gamma_star), b * np.sin(alpha_r) * np.sin(gamma_star), b * np.cos(alpha_r)],
+        [0.0, 0.0, float(c)],
+    ])
+
+# Decimals cell parameters are kept to, as in the lattice inputs of the UI.
+CELL_DECIMALS = 4
+
+def cell_key(parameters):
+    """
+    Cell parameters (a, b, c, alpha, beta, gamma) rounded to CELL_DECIMALS,
+    so a cell read from a .cif and the same cell shown in the UI share one
+    cache and store entry.
+    """
+    return tuple(round(float(x), CELL_DECIMALS) for x in parameters)
+
+class Crystal:
+    """
+    Compact, array-backed crystal record consumed by the diffraction engine.
+
+    Each row is one (site, species) pair: ``frac_coords``, ``zs``, ``occus``
+    and ``coeff_idx`` (row in SCATTERING_COEFFS) are parallel arrays and
+    ``site_idx`` groups the rows sharing a crystallographic site. Arrays are
+    read-only so records can be cached and shared; lattice edits go through
+    ``with_lattice``, which swaps the matrix and reuses everything else.
+    """
+    __slots__ = ("matrix", "frac_coords", "zs", "occus", "coeff_idx", "site_idx")
+
+    def __init__(self, matrix, frac_coords, zs, occus, coeff_idx, site_idx):
+        self.matrix = _frozen(matrix, float)
+        self.frac_coords = _frozen(frac_coords, float).reshape(-1, 3)
+        self.zs = _frozen(zs, float)
+        self.occus = _frozen(occus, float)
+        self.coeff_idx = _frozen(coeff_idx, np.intp)
+        self.site_idx = _frozen(site_idx, np.intp)
+
+    @classmethod
+    def from_structure(cls, structure: Structure):
+        """
+        Flatten a pymatgen Structure into a Crystal.
+        """
+        frac_coords, zs, occus, coeff_idx, site_idx = [], [], [], [], []
+        for i, site in enumerate(structure):
+            for sp, occu in site.species.items():
+                try:
+                    coeff_idx.append(SCATTERING_INDEX[sp.symbol])
+                except KeyError:
+                    raise ValueError(f"No scattering coefficients for {sp.symbol}")
+                frac_coords.append(site.frac_coords)
+                zs.append(sp.Z)
+                occus.append(occu)
+                site_idx.append(i)
+        return cls(structure.lattice.matrix, frac_coords, zs, occus, coeff_idx, site_idx)
+
+    def __reduce__(self):
+        return (Crystal, (self.matrix, self.frac_coords, self.zs, self.occus, self.coeff_idx, self.site_idx))
+
+    def with_lattice(self, matrix):
+        """
+        Return a Crystal with a new lattice matrix and the same sites.
+        """
+        return Crystal(matrix, self.frac_coords, self.zs, self.occus, self.coeff_idx, self.site_idx)
+
+    @property
+    def mass(self):
+        """
+        Mass of the cell contents (ZM) in atomic mass units.
+        """
+        zs, inverse = np.unique(self.zs, return_inverse=True)
+        masses = np.array([float(Element.from_Z(int(z)).atomic_mass) for z in zs])
+        return float(np.sum(masses[inverse] * self.occus))
+
+    @property
+    def volume(self):
+        return float(abs(np.linalg.det(self.matrix)))
+
+    @property
+    def symbols(self):
+        return [SCATTERING_SYMBOLS[i] for i in self.coeff_idx]
+
+    @property
+    def parameters(self):
+        """
+        Cell parameters (a, b, c, alpha, beta, gamma) in angstroms and degrees.
+        """
+        lengths = np.linalg.norm(self.matrix, axis=1)
+        angles = []
+        for i, j in ((1, 2), (0, 2), (0, 1)):
+            cos_angle = np.dot(self.matrix[i], self.matrix[j]) / (lengths[i] * lengths[j])
+            angles.append(degrees(np.arccos(np.clip(cos_angle, -1, 1))))
+        return (*(float(x) for x in lengths), *angles)
+
+    def is_hexagonal(self, hex_angle_tol=5, hex_length_tol=0.01):
+        """
+        Same test as pymatgen's Lattice.is_hexagonal.
+        """
+        params = self.parameters
+        lengths, angles = params[:3], params[3:]
+        right_angles = [i for i in range(3) if abs(angles[i] - 90) <= hex_angle_tol]
+        hex_angles = [i for i in range(3) if abs(angles[i] - 60) <= hex_angle_tol or abs(angles[i] - 120) <= hex_angle_tol]
+        return (
+            len(right_angles) == 2
+            and len(hex_angles) == 1
+            and abs(lengths[right_angles[0]] - lengths[right_angles[1]]) <= hex_length_tol
+        )
+
+def _frozen(values, dtype):
+    arr = np.array(values, dtype=dtype)
+    arr.setflags(write=False)
+    return arr
+
+# States of the "Shift unit cell" slider: -5% to +5% in 0.1% steps.
+SWEEP_SCALES = np.round(np.linspace(-5, 5, 101), 1)
+
+# Memory budget for the temporaries of the hkl enumeration and the
+# structure-factor phase sums, and for one lattice-scale sweep; and the
+# number of threads sharing the phase-sum part.
+PHASE_MEMORY_BUDGET = int(float(os.environ.get("XRD_MEMORY_BUDGET_MB", 256)) * 1024 ** 2)
+PHASE_THREADS = int(os.environ.get("XRD_THREADS", min(8, os.cpu_count() or 1)))
+_phase_pool = None
+
+def _site_phases(hkl, frac_coords, weights):
+    """
+    Phase sums sum_j w_je exp(2πi h·r_j) of every reflection and element
+    column of weights, as a complex (reflection x element) array.
+
+    Friedel mates share one evaluation (the sum for -h is the conjugate).
+    exp(2πi h·r) factorizes into exp(2πi hx) exp(2πi ky) exp(2πi lz), so
+    for each h the sums over all (k, l) are one complex matrix product
+    (k x site) @ (site x l), done in site chunks sized so that all
+    PHASE_THREADS threads together stay within PHASE_MEMORY_BUDGET. The
+    h slabs run in parallel; NumPy releases the GIL in the products.
+    """
+    global _phase_pool
+    hkl = np.asarray(hkl)
+    negative = (hkl[:, 0] < 0) | ((hkl[:, 0] == 0) & ((hkl[:, 1] < 0) | ((hkl[:, 1] == 0) & (hkl[:, 2] < 0))))
+    canonical = np.where(negative[:, None], -hkl, hkl)
+    positions = 2 * pi * np.asarray(frac_coords, dtype=float)
+    sums = np.empty((len(hkl), weights.shape[1]), dtype=complex)
+    order = np.argsort(canonical[:, 0], kind="stable")
+    hs, first = np.unique(canonical[order, 0], return_index=True)
+    bounds = np.append(first, len(order))
+    members = [np.flatnonzero(weights[:, e]) for e in range(weights.shape[1])]
+    budget = PHASE_MEMORY_BUDGET // PHASE_THREADS
+
+    def run(i):
+        rows = order[bounds[i]:bounds[i + 1]]
+        ks, ls = canonical[rows, 1], canonical[rows, 2]
+        k_vals = np.arange(ks.min(), ks.max() + 1)
+        l_vals = np.arange(ls.min(), ls.max() + 1)
+        # Two complex (k or l x site) factors and their temporaries per chunk.
+        step = max(1, budget // (32 * (len(k_vals) + len(l_vals))))
+        for e, sites in enumerate(members):
+            block = np.zeros((len(k_vals), len(l_vals)), dtype=complex)
+            for start in range(0, len(sites), step):
+                j = sites[start:start + step]
+                left = np.exp(1j * np.outer(k_vals, positions[j, 1])) * (weights[j, e] * np.exp(1j * hs[i] * positions[j, 0]))
+                block += left @ np.exp(1j * np.outer(positions[j, 2], l_vals))
+            sums[rows, e] = block[ks - k_vals[0], ls - l_vals[0]]
+
+    if len(hs) > 1 and PHASE_THREADS > 1:
+        if _phase_pool is None:
+            _phase_pool = ThreadPoolExecutor(max_workers=PHASE_THREADS)
+        list(_phase_pool.map(attributed(run), range(len(hs))))
+    else:
+        for i in range(len(hs)):
+            run(i)
+    np.conjugate(sums, out=sums, where=negative[:, None])
+    return sums
+
 class XRDCalculator(AbstractDiffractionPatternCalculator):
     AVAILABLE_RADIATION = tuple(WAVELENGTHS)
 
@@ -38,103 +232,347 @@ class XRDCalculator(AbstractDiffractionPatternCalculator):
         self.symprec = symprec
         self.debye_waller_factors = debye_waller_factors or {}
 
-    def get_pattern(self, structure: Structure, scaled=True, two_theta_range=(0, 90)):
+    def get_pattern(self, structure, scaled=True, two_theta_range=(0, 90)):
+        """
+        Compute the powder pattern of a Crystal (or a pymatgen Structure,
+        which is flattened into a Crystal first).
+        """
+        sweep = self.get_sweep(structure, scales=(0,), two_theta_range=two_theta_range, dtype=float)
+        return sweep.pattern(0, scaled=scaled)
+
+    def get_sweep(self, structure, scales=SWEEP_SCALES, two_theta_range=(0, 90), dtype=np.float32):
+        """
+        Compute the patterns of a crystal under uniform lattice scaling in one
+        batched call, one state per entry of scales (percent change of a, b
+        and c). The hkl set and structure-factor phases are shared by every
+        state; only |g|, the form factors and the Lorentz factor change.
+        Reflections are only enumerated for the two_theta_range shell.
+        """
+        crystal = self._as_crystal(structure)
+        scales = np.asarray(scales, dtype=float)
+        two_theta_range = (0.0, 180.0) if two_theta_range is None else tuple(float(t) for t in two_theta_range)
+        # Enumerate once on the unscaled cell, wide enough for every state.
+        hkl, g_hkl = _reflections(crystal.matrix, *self._g_bounds(two_theta_range, scales))
+        if len(g_hkl) == 0:
+            raise ValueError("No reflections in the requested two_theta_range")
+        return self._sweep_block(crystal, scales, two_theta_range, hkl, g_hkl, dtype)
+
+    def extend_sweep(self, structure, sweep, two_theta_range):
+        """
+        Widen a sweep of the same crystal to cover two_theta_range as well,
+        computing only the reflections outside the range it already covers.
+        """
+        lo = min(float(two_theta_range[0]), sweep.two_theta_range[0])
+        hi = max(float(two_theta_range[1]), sweep.two_theta_range[1])
+        if (lo, hi) == sweep.two_theta_range:
+            return sweep
+        crystal = self._as_crystal(structure)
+        old_lo, old_hi = self._g_bounds(sweep.two_theta_range, sweep.scales)
+        hkl, g_hkl = _reflections(crystal.matrix, *self._g_bounds((lo, hi), sweep.scales))
+        dtype = sweep.two_theta.dtype
+        extended = copy.copy(sweep)
+        below, above = g_hkl < old_lo, g_hkl > old_hi
+        if below.any():
+            extended = self._sweep_block(crystal, sweep.scales, (lo, hi), hkl[below], g_hkl[below], dtype).join(extended)
+        if above.any():
+            extended = extended.join(self._sweep_block(crystal, sweep.scales, (lo, hi), hkl[above], g_hkl[above], dtype))
+        extended.two_theta_range = (lo, hi)
+        return extended
+
+    def reflection_count(self, structure, scales=(0,), two_theta_range=(0, 90)):
+        """
+        Estimated number of reflections get_sweep enumerates: the reciprocal
+        lattice points in the |g| shell it covers.
+        """
+        crystal = self._as_crystal(structure)
+        min_r, max_r = self._g_bounds(two_theta_range, np.asarray(scales, dtype=float))
+        return 4 / 3 * pi * (max_r ** 3 - min_r ** 3) * crystal.volume
+
+    def sweep_nbytes(self, structure, scales=SWEEP_SCALES, two_theta_range=(0, 90), dtype=np.float32):
+        """
+        Estimated size of get_sweep's result (about half as many peak groups
+        as reflections, as Friedel mates always coincide).
+        """
+        reflections = self.reflection_count(structure, scales, two_theta_range)
+        # Per reflection: integer hkl and |g|; per peak group: two_theta and
+        # intensity in every state.
+        return int(reflections * (32 + len(scales) * np.dtype(dtype).itemsize))
+
+    def _g_bounds(self, two_theta_range, scales):
+        # |g| interval of the unscaled cell holding every reflection that
+        # falls inside two_theta_range in at least one state.
+        min_r, max_r = [2 * sin(radians(t / 2)) / self.wavelength for t in two_theta_range]
+        return min_r * (1 + min(scales) / 100), max_r * (1 + max(scales) / 100)
+
+    def _sweep_block(self, crystal, scales, two_theta_range, hkl, g_hkl, dtype):
+        """
+        LatticeSweep of the given reflections (sorted by |g|), with the raw
+        intensity of every peak group in every state where it can diffract.
+        """
+        factors = 1 + scales / 100
+        wavelength = self.wavelength
+
+        # Structure factors: sum the site phases per element once, then weight
+        # them by the s-dependent form factors of each element.
+        elements, inverse = np.unique(crystal.coeff_idx, return_inverse=True)
+        weights = np.zeros((len(crystal.occus), len(elements)))
+        weights[np.arange(len(crystal.occus)), inverse] = crystal.occus
+        phases = _site_phases(hkl, crystal.frac_coords, weights)
+        coeffs = SCATTERING_COEFFS[elements]
+        dw_factors = np.array([self.debye_waller_factors.get(SCATTERING_SYMBOLS[e], 0) for e in elements])
+
+        # Merge reflections whose two_theta coincide within TWO_THETA_TOL;
+        # uniform scaling keeps coincident reflections together.
+        starts = np.flatnonzero(
+            np.diff(_max_two_theta(g_hkl, factors, wavelength), prepend=-np.inf)
+            >= AbstractDiffractionPatternCalculator.TWO_THETA_TOL
+        )
+
+        # Members of a group share |g| to within TWO_THETA_TOL, so |F|^2 summed
+        # over a group is sum_ee' f_e f_e' Re(sum P_e P_e'*) with the form
+        # factors taken at its first reflection: only the (group x element x
+        # element) phase products have to be kept across states.
+        products = np.empty((len(starts), len(elements), len(elements)))
+        for e in range(len(elements)):
+            for e2 in range(e, len(elements)):
+                products[:, e, e2] = products[:, e2, e] = np.add.reduceat(
+                    (phases[:, e] * phases[:, e2].conjugate()).real, starts
+                )
+        g_group = g_hkl[starts]
+
+        two_theta = np.full((len(scales), len(starts)), np.nan, dtype=dtype)
+        intensity = np.full((len(scales), len(starts)), np.nan, dtype=dtype)
+        for k, factor in enumerate(factors):
+            g = g_group / factor
+            valid = wavelength * g / 2 <= 1
+            s2 = (g[valid] / 2) ** 2
+            fs = SCATTERING_Z[elements] - 41.78214 * s2[:, None] * np.sum(
+                coeffs[:, :, 0] * np.exp(-coeffs[:, :, 1] * s2[:, None, None]),
+                axis=2
+            )
+            fs *= np.exp(-dw_factors * s2[:, None])
+            theta = np.arcsin(wavelength * g[valid] / 2)
+            lorentz_factor = (1 + np.cos(2 * theta) ** 2) / (np.sin(theta) ** 2 * np.cos(theta))
+            two_theta[k, valid] = np.degrees(2 * theta)
+            intensity[k, valid] = np.einsum("ge,gef,gf->g", fs, products[valid], fs) * lorentz_factor
+
+        if crystal.is_hexagonal():
+            hkl = np.column_stack((hkl[:, 0], hkl[:, 1], -hkl[:, 0] - hkl[:, 1], hkl[:, 2]))
+        return LatticeSweep(scales, two_theta_range, two_theta, intensity, g_hkl, hkl, starts, wavelength)
+
+    def _as_crystal(self, structure):
+        if isinstance(structure, Crystal):
+            return structure
         if self.symprec:
             finder = SpacegroupAnalyzer(structure, symprec=self.symprec)
             structure = finder.get_refined_structure()
+        return Crystal.from_structure(structure)
 
-        wavelength = self.wavelength
-        lattice = structure.lattice
-        is_hex = lattice.is_hexagonal()
+class LatticeSweep:
+    """
+    Patterns of one crystal for a set of uniform lattice scales, stored as
+    (scale x peak group) arrays of raw intensities, complete for every peak
+    inside two_theta_range. Peaks a state cannot diffract are NaN there; the
+    range window, intensity threshold and scaling are applied by pattern().
+    hkl families are resolved per peak group on first use and shared by all
+    states and the patterns taken from them.
+    """
+    __slots__ = ("scales", "two_theta_range", "two_theta", "intensity", "d_hkls",
+                 "_g", "_hkl", "_starts", "_wavelength", "_families")
+
+    def __init__(self, scales, two_theta_range, two_theta, intensity, g_hkl, hkl, starts, wavelength):
+        self.scales = scales
+        self.two_theta_range = two_theta_range
+        self.two_theta = two_theta
+        self.intensity = intensity
+        self.d_hkls = 1 / g_hkl[starts]
+        self._g = g_hkl
+        self._hkl = hkl
+        self._starts = np.append(starts, len(hkl))
+        self._wavelength = wavelength
+        self._families = {}
+
+    def to_arrays(self):
+        """
+        (meta, arrays) form used to keep the sweep in the on-disk store.
+        """
+        meta = {"two_theta_range": list(self.two_theta_range), "wavelength": self._wavelength}
+        arrays = {"scales": self.scales, "two_theta": self.two_theta, "intensity": self.intensity,
+                  "g": self._g, "hkl": self._hkl, "starts": self._starts[:-1]}
+        return meta, arrays
+
+    @property
+    def nbytes(self):
+        return sum(values.nbytes for values in self.to_arrays()[1].values()) + self.d_hkls.nbytes
+
+    @classmethod
+    def from_arrays(cls, meta, arrays):
+        return cls(arrays["scales"], tuple(meta["two_theta_range"]), arrays["two_theta"], arrays["intensity"],
+                   arrays["g"], arrays["hkl"], arrays["starts"], meta["wavelength"])
+
+    def covers(self, two_theta_range):
+        """
+        Whether every peak inside two_theta_range is part of this sweep.
+        """
+        return _covers(self.two_theta_range, two_theta_range)
 
-        min_r, max_r = (
-            (0, 2 / wavelength)
-            if two_theta_range is None
-            else [2 * sin(radians(t / 2)) / wavelength for t in two_theta_range]
+    def join(self, upper):
+        """
+        Sweep holding the peak groups of self followed by those of upper, a
+        sweep of the same crystal and states with every reflection further
+        out. The boundary groups are merged if they coincide in two_theta.
+        """
+        two_theta, intensity = upper.two_theta, upper.intensity
+        starts = upper._starts[:-1] + len(self._hkl)
+        factors = 1 + self.scales / 100
+        gap = np.diff(_max_two_theta(np.array([self._g[-1], upper._g[0]]), factors, self._wavelength))[0]
+        head = self.intensity
+        fused = gap < AbstractDiffractionPatternCalculator.TWO_THETA_TOL
+        if fused:
+            head = head.copy()
+            head[:, -1] += np.nan_to_num(intensity[:, 0])
+            two_theta, intensity, starts = two_theta[:, 1:], intensity[:, 1:], starts[1:]
+        joined = LatticeSweep(
+            self.scales,
+            (min(self.two_theta_range[0], upper.two_theta_range[0]), max(self.two_theta_range[1], upper.two_theta_range[1])),
+            np.hstack((self.two_theta, two_theta)),
+            np.hstack((head, intensity)),
+            np.concatenate((self._g, upper._g)),
+            np.concatenate((self._hkl, upper._hkl)),
+            np.concatenate((self._starts[:-1], starts)),
+            self._wavelength,
         )
+        # Keep the families already resolved, except for a merged group.
+        n = len(self.d_hkls) - fused
+        joined._families.update((g, fam) for g, fam in self._families.items() if g < n)
+        joined._families.update((g + n, fam) for g, fam in upper._families.items() if g >= fused)
+        return joined
 
-        recip_lattice = lattice.reciprocal_lattice_crystallographic
-        recip_pts = recip_lattice.get_points_in_sphere([[0, 0, 0]], [0, 0, 0], max_r)
-        if min_r:
-            recip_pts = [pt for pt in recip_pts if pt[1] >= min_r]
+    def index(self, scale):
+        """
+        Row holding the given scale, or None if it is not one of the states.
+        """
+        k = int(np.argmin(np.abs(self.scales - scale)))
+        return k if abs(self.scales[k] - scale) < 1e-6 else None
 
-        _zs, _coeffs, _frac_coords, _occus, _dw_factors = [], [], [], [], []
-        for site in structure:
-            for sp, occu in site.species.items():
-                _zs.append(sp.Z)
-                try:
-                    c = ATOMIC_SCATTERING_PARAMS[sp.symbol]
-                except KeyError:
-                    raise ValueError(f"No scattering coefficients for {sp.symbol}")
-                _coeffs.append(c)
-                _dw_factors.append(self.debye_waller_factors.get(sp.symbol, 0))
-                _frac_coords.append(site.frac_coords)
-                _occus.append(occu)
-        zs = np.array(_zs)
-        coeffs = np.array(_coeffs)
-        frac_coords = np.array(_frac_coords)
-        occus = np.array(_occus)
-        dw_factors = np.array(_dw_factors)
-        peaks = {}
-        two_thetas = []
-
-        for hkl, g_hkl, ind, _ in sorted(recip_pts, key=lambda i: (i[1], -i[0][0], -i[0][1], -i[0][2])):
-            hkl = [int(round(i)) for i in hkl]
-            if g_hkl != 0:
-                theta = asin(wavelength * g_hkl / 2)
-                s = g_hkl / 2
-                s2 = s**2
-                g_dot_r = np.dot(frac_coords, np.transpose([hkl])).T[0]
-                fs = zs - 41.78214 * s2 * np.sum(
-                    coeffs[:, :, 0] * np.exp(-coeffs[:, :, 1] * s2),
-                    axis=1
-                )
-                dw_correction = np.exp(-dw_factors * s2)
-                f_hkl = np.sum(fs * occus * np.exp(2j * pi * g_dot_r) * dw_correction)
-                lorentz_factor = (1 + cos(2 * theta) ** 2) / (sin(theta) ** 2 * cos(theta))
-                i_hkl = (f_hkl * f_hkl.conjugate()).real
-                two_theta = degrees(2 * theta)
-                if is_hex:
-                    hkl = (hkl[0], hkl[1], -hkl[0] - hkl[1], hkl[2])
-                ind = np.where(
-                    np.abs(np.subtract(two_thetas, two_theta)) < AbstractDiffractionPatternCalculator.TWO_THETA_TOL
-                )
-                if len(ind[0]) > 0:
-                    peaks[two_thetas[ind[0][0]]][0] += i_hkl * lorentz_factor
-                    peaks[two_thetas[ind[0][0]]][1].append(tuple(hkl))
-                else:
-                    d_hkl = 1 / g_hkl
-                    peaks[two_theta] = [i_hkl * lorentz_factor, [tuple(hkl)], d_hkl]
-                    two_thetas.append(two_theta)
-        max_intensity = max(v[0] for v in peaks.values())
-        x = []
-        y = []
-        hkls = []
-        d_hkls = []
-        for k in sorted(peaks):
-            v = peaks[k]
-            fam = get_unique_families(v[1])
-            if v[0] / max_intensity * 100 > AbstractDiffractionPatternCalculator.SCALED_INTENSITY_TOL:
-                x.append(k)
-                y.append(v[0])
-                hkls.append([{"hkl": hkl, "multiplicity": mult} for hkl, mult in fam.items()])
-                d_hkls.append(v[2])
-        xrd = DiffractionPattern(x, y, hkls, d_hkls)
-        if scaled:
-            xrd.normalize(mode="max", value=100)
-        return xrd
-
-def normalize_structure(structure: Structure) -> Structure:
-    """
-    Normalize a structure by setting all site occupancies to 1.
-    """
-    species = []
-    coords = []
-    for site in structure:
-        max_species = max(site.species.items(), key=lambda x: x[1])[0]
-        species.append(max_species)
-        coords.append(site.frac_coords)
-    return Structure(structure.lattice, species, coords, coords_are_cartesian=False)
+    def families(self, group):
+        """
+        hkl families (pymatgen DiffractionPattern format) of a peak group.
+        """
+        fam = self._families.get(group)
+        if fam is None:
+            rows = self._hkl[self._starts[group]:self._starts[group + 1]]
+            unique = get_unique_families([tuple(int(i) for i in row) for row in rows])
+            fam = self._families[group] = [{"hkl": h, "multiplicity": mult} for h, mult in unique.items()]
+        return fam
+
+    def pattern(self, scale=0, scaled=True, two_theta_range=None):
+        """
+        XRDPattern of one state within two_theta_range (default: the whole
+        range of the sweep); a lookup, nothing is recomputed.
+        """
+        k = self.index(scale)
+        if k is None:
+            raise KeyError(f"Scale {scale} is not part of this sweep")
+        if two_theta_range is None:
+            two_theta_range = self.two_theta_range
+        elif not self.covers(two_theta_range):
+            raise ValueError(f"two_theta_range {two_theta_range} is outside the sweep range {self.two_theta_range}")
+        two_theta, intensity = self.two_theta[k], self.intensity[k]
+        in_range = (two_theta >= two_theta_range[0]) & (two_theta <= two_theta_range[1])
+        keep = np.empty(0, dtype=int)
+        if in_range.any():
+            keep = np.flatnonzero(in_range & (
+                intensity / intensity[in_range].max() * 100 > AbstractDiffractionPatternCalculator.SCALED_INTENSITY_TOL
+            ))
+        peaks = np.empty(len(keep), dtype=PATTERN_DTYPE)
+        peaks["two_theta"] = two_theta[keep]
+        peaks["intensity"] = intensity[keep]
+        peaks["d"] = self.d_hkls[keep] * (1 + self.scales[k] / 100)
+        peaks["family"] = keep
+        if scaled and len(keep):
+            peaks["intensity"] *= 100 / peaks["intensity"].max()
+        return XRDPattern(peaks, self)
+
+# One row per peak of an XRDPattern; "family" indexes the peak group whose hkl
+# families the source sweep resolves on demand.
+PATTERN_DTYPE = np.dtype([("two_theta", "f8"), ("intensity", "f8"), ("d", "f8"), ("family", "i4")])
+
+class XRDPattern:
+    """
+    Compact powder pattern backed by one PATTERN_DTYPE structured array.
+    x, y and d_hkls are views of its columns; hkl families are only worked
+    out when hkls or families() is used.
+    """
+    __slots__ = ("peaks", "_source")
+
+    def __init__(self, peaks, source):
+        self.peaks = peaks
+        self._source = source
+
+    def __len__(self):
+        return len(self.peaks)
+
+    @property
+    def x(self):
+        return self.peaks["two_theta"]
+
+    @property
+    def y(self):
+        return self.peaks["intensity"]
+
+    @y.setter
+    def y(self, values):
+        self.peaks["intensity"] = values
+
+    @property
+    def d_hkls(self):
+        return self.peaks["d"]
+
+    def families(self, i):
+        """
+        hkl families of peak i, as [{"hkl": ..., "multiplicity": ...}].
+        """
+        return self._source.families(int(self.peaks["family"][i]))
+
+    @property
+    def hkls(self):
+        return [self._source.families(int(group)) for group in self.peaks["family"]]
+
+    def to_diffraction_pattern(self):
+        """
+        Equivalent pymatgen DiffractionPattern (resolves every hkl family).
+        """
+        return DiffractionPattern(self.x.copy(), self.y.copy(), self.hkls, self.d_hkls.copy())
+
+def _max_two_theta(g_hkl, factors, wavelength):
+    # two_theta (degrees) of reflections in the state with the largest cell,
+    # where every reflection of the sweep can diffract.
+    return np.degrees(2 * np.arcsin(wavelength * g_hkl / factors.max() / 2))
+
+def _reflections(matrix, min_r, max_r):
+    """
+    Enumerate the reciprocal lattice points with min_r <= |g| <= max_r.
+    Returns integer hkl rows and |g|, sorted by |g| then descending h, k, l.
+    The hkl box is walked in h slabs sized to PHASE_MEMORY_BUDGET.
+    """
+    recip = np.linalg.inv(matrix).T
+    bounds = np.floor(max_r * np.linalg.norm(matrix, axis=1) + 1e-8).astype(int)
+    kl = np.stack(np.meshgrid(np.arange(-bounds[1], bounds[1] + 1), np.arange(-bounds[2], bounds[2] + 1),
+                              indexing="ij"), axis=-1).reshape(-1, 2)
+    # Integer hkl rows, their g vectors, |g| and the mask: ~64 bytes a point.
+    step = max(1, PHASE_MEMORY_BUDGET // (64 * len(kl)))
+    hkls, g_hkls = [], []
+    for h0 in range(-bounds[0], bounds[0] + 1, step):
+        hs = np.arange(h0, min(h0 + step, bounds[0] + 1))
+        hkl = np.column_stack((np.repeat(hs, len(kl)), np.tile(kl, (len(hs), 1))))
+        g_hkl = np.linalg.norm(hkl @ recip, axis=1)
+        mask = (g_hkl <= max_r) & (g_hkl >= min_r) & (g_hkl > 0)
+        hkls.append(hkl[mask])
+        g_hkls.append(g_hkl[mask])
+    hkl, g_hkl = np.concatenate(hkls), np.concatenate(g_hkls)
+    order = np.lexsort((-hkl[:, 2], -hkl[:, 1], -hkl[:, 0], g_hkl))
+    return hkl[order], g_hkl[order]
 
 def parse_xy(contents):
     """
@@ -147,6 +585,121 @@ def parse_xy(contents):
     df.columns = ['2_theta', 'intensity']
     return df
 
+# Cu K-alpha1/K-alpha2 wavelengths (angstroms) and intensity ratio used for
+# K-alpha2 stripping.
+KALPHA_WAVELENGTHS = {"CuKa": (1.540562, 1.544398)}
+KALPHA2_RATIO = 0.5
+# Default experimental-data preprocessing parameters.
+XY_BACKGROUND_WIDTH = 2.0  # SNIP clipping window, degrees 2θ
+XY_SMOOTH_WINDOW = 11      # Savitzky-Golay window, points
+XY_SMOOTH_ORDER = 2
+SNIP_MAX_ITERATIONS = 64
+
+def snip_background(two_theta, intensity, width=XY_BACKGROUND_WIDTH):
+    """
+    Estimate the background with the SNIP clipping algorithm on the LLS
+    transformed intensity. The clipping window spans width degrees; wide
+    windows run on a block-averaged copy of the scan, which keeps the cost
+    linear in the number of points.
+    """
+    intensity = np.asarray(intensity, dtype=float)
+    n = len(intensity)
+    step = (two_theta[-1] - two_theta[0]) / max(n - 1, 1)
+    window = max(1, int(round(width / step))) if step > 0 else 1
+    block = max(1, int(np.ceil(window / SNIP_MAX_ITERATIONS)))
+    n_blocks = int(np.ceil(n / block))
+    padded = np.pad(intensity, (0, n_blocks * block - n), mode="edge")
+    coarse = padded.reshape(n_blocks, block).mean(axis=1)
+
+    v = np.log(np.log(np.sqrt(np.maximum(coarse, 0) + 1) + 1) + 1)
+    for p in range(1, min(int(np.ceil(window / block)), (n_blocks - 1) // 2) + 1):
+        v[p:-p] = np.minimum(v[p:-p], (v[:-2 * p] + v[2 * p:]) / 2)
+    coarse_bg = (np.exp(np.exp(v) - 1) - 1) ** 2 - 1
+    if block == 1:
+        return coarse_bg
+    centers = np.arange(n_blocks) * block + (block - 1) / 2
+    return np.interp(np.arange(n), centers, coarse_bg)
+
+def savgol_smooth(intensity, window=XY_SMOOTH_WINDOW, order=XY_SMOOTH_ORDER):
+    """
+    Savitzky-Golay smoothing as a single convolution; the ends are padded
+    with the edge values.
+    """
+    half = window // 2
+    offsets = np.arange(-half, half + 1)
+    coeffs = np.linalg.pinv(np.vander(offsets, order + 1, increasing=True))[0]
+    return np.convolve(np.pad(intensity, half, mode="edge"), coeffs[::-1], mode="valid")
+
+def strip_kalpha2(two_theta, intensity, radiation="CuKa", ratio=KALPHA2_RATIO):
+    """
+    Remove the K-alpha2 contribution with Rachinger's method,
+    I1(2θ) = I(2θ) - ratio * I1(2θ'), where 2θ' is the K-alpha1 position whose
+    K-alpha2 line falls at 2θ. two_theta must be ascending. Points are
+    processed in blocks whose K-alpha1 positions all lie at or below the
+    last stripped point, so every block only depends on already stripped
+    data and is vectorized; the result equals the point-by-point recursion.
+    """
+    lambda1, lambda2 = KALPHA_WAVELENGTHS[radiation]
+    two_theta = np.asarray(two_theta, dtype=float)
+    intensity = np.asarray(intensity, dtype=float)
+    source = np.degrees(2 * np.arcsin(np.sin(np.radians(two_theta) / 2) * lambda1 / lambda2))
+    stripped = np.empty_like(intensity)
+    i, n = 0, len(intensity)
+    while i < n:
+        j = i + 1
+        if i > 0:
+            j = max(j, int(np.searchsorted(source, two_theta[i - 1], side="right")))
+        lo = max(0, int(np.searchsorted(two_theta, source[i:j].min())) - 1)
+        if i > 0:
+            contribution = np.interp(source[i:j], two_theta[lo:i], stripped[lo:i], left=0)
+        else:
+            contribution = 0
+        stripped[i:j] = intensity[i:j] - ratio * contribution
+        i = j
+    return stripped
+
+def preprocess_xy(two_theta, intensity, background=False, smooth=False, kalpha2=False,
+                  background_width=XY_BACKGROUND_WIDTH, smooth_window=XY_SMOOTH_WINDOW):
+    """
+    Optional cleanup of an experimental scan: Savitzky-Golay smoothing, SNIP
+    background subtraction and K-alpha2 stripping, in that order. The result
+    is clipped at zero and max-normalized to 100.
+    """
+    y = np.asarray(intensity, dtype=float)
+    if smooth:
+        y = savgol_smooth(y, smooth_window)
+    if background:
+        y = y - snip_background(two_theta, y, background_width)
+    if kalpha2:
+        y = strip_kalpha2(two_theta, y)
+    y = np.clip(y, 0, None)
+    return y / y.max() * 100 if y.max() > 0 else y
+
+@lru_cache(maxsize=4)
+def load_xy(contents):
+    """
+    Parse an uploaded .xy file once; returns read-only (two_theta, intensity)
+    arrays sorted by angle.
+    """
+    df = parse_xy(contents).sort_values('2_theta')
+    two_theta = df['2_theta'].to_numpy(dtype=float)
+    intensity = df['intensity'].to_numpy(dtype=float)
+    two_theta.setflags(write=False)
+    intensity.setflags(write=False)
+    return two_theta, intensity
+
+@lru_cache(maxsize=16)
+def load_processed_xy(contents, options=()):
+    """
+    Uploaded scan with the preprocessing steps named in options applied
+    ("background", "smooth", "kalpha2"). Cached per upload and option set,
+    so toggling options back and forth never reprocesses the same data.
+    """
+    two_theta, intensity = load_xy(contents)
+    processed = preprocess_xy(two_theta, intensity, **{option: True for option in options})
+    processed.setflags(write=False)
+    return two_theta, processed
+
 def parse_cif(contents):
     """
     Parse the contents of an uploaded .cif file and return a pymatgen Structure object.
@@ -157,4 +710,312 @@ def parse_cif(contents):
     parser = CifParser(s)
     # Use parse_structures instead of the deprecated get_structures
     structures = parser.parse_structures()  # You can pass primitive=True if needed
-    return structures[0]
\ No newline at end of file
+    return structures[0]
+
+# Tolerances used when expanding atom sites by symmetry (fractional units).
+CIF_SITE_TOLERANCE = 1e-4
+CIF_FRAC_TOLERANCE = 1e-4
+
+_CIF_TOKEN = re.compile(r"""'.*?'(?=\s|$)|".*?"(?=\s|$)|\S+""")
+
+def _cif_blocks(text):
+    """
+    Split CIF text into data blocks, each a dict mapping lower-case tags
+    (dots normalized to underscores) to lists of raw string values.
+    """
+    blocks = []
+    block = None
+    loop_tags, loop_values, in_loop_header = None, None, False
+    pending_tag = None
+
+    def close_loop():
+        if loop_tags:
+            if len(loop_values) % len(loop_tags):
+                raise ValueError("Loop values do not match loop tags")
+            for k, tag in enumerate(loop_tags):
+                block[tag] = loop_values[k::len(loop_tags)]
+
+    def add_value(value):
+        nonlocal pending_tag, in_loop_header
+        if pending_tag is not None:
+            block[pending_tag] = [value]
+            pending_tag = None
+        elif loop_tags is not None:
+            in_loop_header = False
+            loop_values.append(value)
+        else:
+            raise ValueError(f"Unexpected CIF value {value!r}")
+
+    lines = iter(text.splitlines())
+    for line in lines:
+        if line.startswith(";"):
+            field = [line[1:]]
+            for line in lines:
+                if line.startswith(";"):
+                    break
+                field.append(line)
+            add_value("\n".join(field).strip())
+            continue
+        for token in _CIF_TOKEN.findall(line):
+            if token.startswith("#"):
+                break
+            lower = token.lower()
+            if lower.startswith("data_"):
+                close_loop()
+                block = {}
+                blocks.append(block)
+                loop_tags, pending_tag = None, None
+            elif block is None:
+                continue
+            elif lower == "loop_":
+                close_loop()
+                loop_tags, loop_values, in_loop_header = [], [], True
+            elif token.startswith("_") and pending_tag is None:
+                tag = lower.replace(".", "_")
+                if loop_tags is not None and in_loop_header:
+                    loop_tags.append(tag)
+                else:
+                    close_loop()
+                    loop_tags = None
+                    pending_tag = tag
+            else:
+                if token[0] in "'\"" and len(token) > 1 and token[-1] == token[0]:
+                    token = token[1:-1]
+                add_value(token)
+    if block is not None:
+        close_loop()
+    return blocks
+
+def _cif_number(value):
+    value = re.sub(r"\(\d+\)$", "", value.strip())
+    if "/" in value:
+        num, den = value.split("/")
+        return float(num) / float(den)
+    return float(value)
+
+def _parse_symop(op):
+    """
+    Parse a symmetry operator such as '-x+1/2, y, z-y' into (rotation, translation).
+    """
+    parts = op.replace(" ", "").lower().split(",")
+    if len(parts) != 3:
+        raise ValueError(f"Cannot parse symmetry operator {op!r}")
+    rot = np.zeros((3, 3))
+    trans = np.zeros(3)
+    for i, part in enumerate(parts):
+        for term in re.findall(r"[+-]?[^+-]+", part):
+            sign = -1.0 if term[0] == "-" else 1.0
+            term = term.lstrip("+-")
+            if term[-1] in "xyz":
+                coeff = term[:-1].rstrip("*")
+                rot[i, "xyz".index(term[-1])] += sign * (_cif_number(coeff) if coeff else 1.0)
+            else:
+                trans[i] += sign * _cif_number(term)
+    return rot, trans
+
+def _cif_element(value):
+    match = re.match(r"[A-Za-z]{1,2}", value)
+    if match is None:
+        raise ValueError(f"Cannot determine element from {value!r}")
+    symbol = match.group(0).capitalize()
+    if symbol not in SCATTERING_INDEX:
+        symbol = symbol[0]
+    if symbol not in SCATTERING_INDEX:
+        raise ValueError(f"No scattering coefficients for {value!r}")
+    return symbol
+
+def parse_cif_fast(text):
+    """
+    Read only what the diffraction engine needs from CIF text (cell, symmetry
+    operators, atom sites and occupancies) and expand the sites into a Crystal.
+    Raises ValueError for anything it does not handle, in which case callers
+    should fall back to pymatgen's CifParser.
+    """
+    for block in _cif_blocks(text):
+        if "_atom_site_fract_x" in block:
+            break
+    else:
+        raise ValueError("No atom sites with fractional coordinates")
+
+    params = [
+        _cif_number(block[f"_cell_{name}"][0])
+        for name in ("length_a", "length_b", "length_c", "angle_alpha", "angle_beta", "angle_gamma")
+    ]
+    ops = block.get("_space_group_symop_operation_xyz") or block.get("_symmetry_equiv_pos_as_xyz")
+    if not ops:
+        raise ValueError("No symmetry operators")
+    symops = [_parse_symop(op) for op in ops]
+    rots = np.array([r for r, _ in symops])
+    trans = np.array([t for _, t in symops])
+
+    coords = np.array([
+        [_cif_number(v) for v in block[f"_atom_site_fract_{axis}"]] for axis in "xyz"
+    ]).T
+    # Snap finite-precision thirds (0.3333, 0.6667) as pymatgen does.
+    for frac in (1 / 3, 2 / 3):
+        coords[np.abs(coords / frac - 1) <= CIF_FRAC_TOLERANCE] = frac
+    names = block.get("_atom_site_type_symbol") or block["_atom_site_label"]
+    symbols = [_cif_element(name) for name in names]
+    occus = np.array([
+        1.0 if v in ("?", ".") else _cif_number(v)
+        for v in block.get("_atom_site_occupancy", ["1"] * len(symbols))
+    ])
+    if len(symbols) != len(coords) or len(occus) != len(coords):
+        raise ValueError("Inconsistent atom site loop")
+
+    # Apply every operator to every site, wrap into [0, 1), then drop the
+    # images that coincide within CIF_SITE_TOLERANCE.
+    images = np.einsum("oij,aj->aoi", rots, coords) + trans[None, :, :]
+    resolution = 1 / CIF_SITE_TOLERANCE
+    keys = np.round(images * resolution).astype(np.int64) % int(resolution)
+    n_atoms, n_ops = images.shape[:2]
+    rows = np.repeat(np.arange(n_atoms), n_ops)
+    keys = keys.reshape(-1, 3)
+    _, first = np.unique(np.column_stack((rows, keys)), axis=0, return_index=True)
+    first = np.sort(first)
+    rows, keys = rows[first], keys[first]
+    frac_coords = images.reshape(-1, 3)[first] % 1.0
+
+    # Rows from different atom_site entries on the same position share a site.
+    _, site_idx = np.unique(keys, axis=0, return_inverse=True)
+    coeff_idx = np.array([SCATTERING_INDEX[s] for s in symbols])[rows]
+    return Crystal(lattice_matrix(*params), frac_coords, SCATTERING_Z[coeff_idx], occus[rows], coeff_idx, site_idx.ravel())
+
+def _decode_upload(contents):
+    content_type, content_string = contents.split(',')
+    return base64.b64decode(content_string).decode('utf-8')
+
+def _parse_crystal(contents):
+    try:
+        crystal = parse_cif_fast(_decode_upload(contents))
+    except Exception:
+        # Anything the fast reader cannot handle goes through pymatgen.
+        crystal = Crystal.from_structure(parse_cif(contents))
+    return crystal
+
+@lru_cache(maxsize=32)
+def load_crystal(contents):
+    """
+    Parse an uploaded .cif once and return its Crystal record, with every
+    (site, species, occupancy) of mixed sites kept.
+    Repeated calls with the same upload reuse the cached record.
+    """
+    return _parse_crystal(contents)
+
+def cif_contents(text):
+    """
+    Wrap CIF text in the data-URL form dcc.Upload produces, so text sent by
+    other clients shares the upload caches.
+    """
+    return "data:chemical/x-cif;base64," + base64.b64encode(text.encode('utf-8')).decode('ascii')
+
+def load_pattern(contents, parameters=None, scale=0, wavelength="CuKa", two_theta_range=(10, 120)):
+    """
+    Single pattern of an uploaded .cif with its cell set to parameters
+    (a, b, c, alpha, beta, gamma; None keeps the CIF cell) and uniformly
+    scaled by scale percent, one of SWEEP_SCALES. Looked up in load_sweep,
+    so it shares the cached and stored sweeps of the UI.
+    """
+    if parameters is None:
+        parameters = load_crystal(contents).parameters
+    sweep = load_sweep(contents, parameters, wavelength, two_theta_range, scale)
+    return sweep.pattern(scale, two_theta_range=two_theta_range)
+
+# Sweeps are cached per upload and cell, computed over 2θ windows widened to
+# multiples of SWEEP_RANGE_STEP degrees so nearby windows share one sweep.
+# The cache is bounded by the size of the sweeps (a large cell's sweep can
+# take hundreds of MB), always keeping the most recent one.
+SWEEP_CACHE_MAX_BYTES = int(float(os.environ.get("XRD_SWEEP_CACHE_MB", 512)) * 1024 ** 2)
+SWEEP_RANGE_STEP = 5
+# Part of the store key; bump when the computed values change.
+SWEEP_STORE_VERSION = 2
+_sweep_cache = LRUCache(max_size=SWEEP_CACHE_MAX_BYTES, size=lambda sweep: sweep.nbytes)
+
+def sweep_range(two_theta_range, step=SWEEP_RANGE_STEP):
+    """
+    two_theta_range widened outward to multiples of step, within (0, 180).
+    """
+    lo, hi = two_theta_range
+    return float(max(0, np.floor(lo / step) * step)), float(min(180, np.ceil(hi / step) * step))
+
+def _covers(outer, inner):
+    return outer[0] <= inner[0] and inner[1] <= outer[1]
+
+def load_sweep(contents, parameters, wavelength="CuKa", two_theta_range=(10, 120), scale=0):
+    """
+    Lattice-scale sweep of an uploaded .cif with its cell set to parameters
+    (a, b, c, alpha, beta, gamma; see cell_key), covering at least
+    two_theta_range. Cached per upload and cell, so moving the "Shift unit cell" slider is a lookup;
+    asking for a wider range extends the cached sweep with only the missing
+    reflections. Computed sweeps also go to the on-disk store, keyed by the
+    CIF content and cell, so other workers and later runs memory-map them
+    instead of recomputing. Cells whose full sweep would exceed
+    PHASE_MEMORY_BUDGET get a sweep of the requested scale only.
+    """
+    parameters = cell_key(parameters)
+    key = (contents, parameters, wavelength)
+    window = sweep_range(two_theta_range)
+    sweep = _sweep_cache.get(key)
+    if sweep is not None and sweep.covers(window) and sweep.index(scale) is not None:
+        return sweep
+    crystal = load_crystal(contents).with_lattice(lattice_matrix(*parameters))
+    calculator = XRDCalculator(wavelength)
+    scales = SWEEP_SCALES
+    if calculator.sweep_nbytes(crystal, scales, window) > PHASE_MEMORY_BUDGET:
+        scales = np.array([float(scale)])
+    if sweep is not None and not np.array_equal(sweep.scales, scales):
+        sweep = None
+    # Other workers (or an earlier run) may already have stored it on disk.
+    digest = store.content_key(SWEEP_STORE_VERSION, contents.split(",", 1)[-1], parameters, wavelength,
+                               scales.tobytes())
+    stored = store.load_entry(digest, lambda meta: _covers(meta["two_theta_range"], window))
+    if stored is not None:
+        sweep = LatticeSweep.from_arrays(*stored)
+    else:
+        if sweep is None:
+            sweep = calculator.get_sweep(crystal, scales, two_theta_range=window)
+        else:
+            sweep = calculator.extend_sweep(crystal, sweep, window)
+        try:
+            meta, arrays = sweep.to_arrays()
+            store.save_entry(digest, "{:g}-{:g}".format(*sweep.two_theta_range), meta, arrays,
+                             supersedes=lambda old: _covers(sweep.two_theta_range, old["two_theta_range"]))
+        except OSError as e:
+            print("Error storing sweep:", e)
+    return _sweep_cache.put(key, sweep)
+
+def warm_store(directory):
+    """
+    Compute and store the default-range sweeps of every .cif in directory
+    (reference phases), skipping those already stored.
+    """
+    for path in sorted(glob.glob(os.path.join(directory, "*.cif"))):
+        try:
+            with open(path) as f:
+                contents = cif_contents(f.read())
+            load_sweep(contents, load_crystal(contents).parameters)
+        except Exception as e:
+            print("Error warming pattern store with", path, ":", e)
+
+# Broadened phase profiles on an experimental grid, cached per phase state
+# so re-fitting after one phase changes only rebuilds that phase.
+_profile_cache = LRUCache(max_items=64)
+
+def load_profile(contents, parameters, scale, two_theta, wavelength="CuKa"):
+    """
+    Profile of an uploaded .cif (cell set to parameters, shifted by scale
+    percent) on the sorted 2θ grid two_theta, from its max-100 pattern.
+    Returns (profile, raw_max), raw_max being the unscaled intensity that
+    maps to 100.
+    """
+    two_theta = np.asarray(two_theta, dtype=float)
+    key = (contents, cell_key(parameters), float(scale), wavelength, array_key(two_theta))
+    cached = _profile_cache.get(key)
+    if cached is not None:
+        return cached
+    window = (float(two_theta[0]), float(two_theta[-1]))
+    sweep = load_sweep(contents, parameters, wavelength, two_theta_range=window, scale=scale)
+    raw = sweep.pattern(scale, scaled=False, two_theta_range=window)
+    raw_max = float(raw.y.max()) if len(raw) else 0.0
+    heights = raw.y * (100 / raw_max) if raw_max > 0 else raw.y
+    return _profile_cache.put(key, (stick_profile(raw.x, heights, two_theta), raw_max))
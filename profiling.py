@@ -0,0 +1,228 @@
+import os
+import sys
+import json
+import time
+import glob
+import inspect
+import hashlib
+import cProfile
+import itertools
+import contextvars
+import tempfile
+import threading
+import functools
+from flask import has_request_context, request
+
+# XRD_PROFILE=1 profiles every call of a @profiled function; XRD_PROFILE=header
+# only calls made while serving a request that carries PROFILE_HEADER. Unset,
+# @profiled returns the function unchanged.
+PROFILE_MODE = os.environ.get("XRD_PROFILE", "").strip().lower()
+PROFILE_HEADER = "X-XRD-Profile"
+PROFILE_DIR = os.environ.get("XRD_PROFILE_DIR", os.path.join(tempfile.gettempdir(), "xrd-profiles"))
+# Oldest captures are deleted once the directory grows past this.
+PROFILE_MAX_BYTES = int(float(os.environ.get("XRD_PROFILE_MAX_MB", 200)) * 1024 ** 2)
+SAMPLE_INTERVAL = 0.001
+_capture_ids = itertools.count()
+# StackSampler of the profiled call the current code runs for, if any.
+_capture = contextvars.ContextVar("xrd_profile_capture", default=None)
+
+def input_hash(args, kwargs):
+    """
+    Short content hash of a call's arguments (the request body for views
+    without arguments), used to tag its captures.
+    """
+    if not args and not kwargs and has_request_context():
+        data = request.get_data()
+    else:
+        data = json.dumps([args, kwargs], sort_keys=True, default=repr).encode()
+    return hashlib.sha1(data).hexdigest()[:12]
+
+def _enabled():
+    if PROFILE_MODE == "header":
+        return has_request_context() and request.headers.get(PROFILE_HEADER, "") not in ("", "0")
+    return True
+
+def _stack(frame, stop_frame=None):
+    stack = []
+    while frame is not None and frame is not stop_frame:
+        code = frame.f_code
+        if code.co_filename != cProfile.__file__:
+            stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+        frame = frame.f_back
+    return stack[::-1]
+
+class StackSampler(threading.Thread):
+    """
+    Samples call stacks every SAMPLE_INTERVAL seconds: the frames of thread
+    thread_id below stop_frame (the profiled call), and those of the pool
+    workers running tasks submitted for the call (see attributed), under a
+    "thread <name>" root frame.
+    """
+    def __init__(self, thread_id, stop_frame):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.stop_frame = stop_frame
+        self.workers = {}
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        last = time.perf_counter()
+        while not self.stopped.wait(SAMPLE_INTERVAL):
+            frames = sys._current_frames()
+            now = time.perf_counter()
+            workers = dict(self.workers)
+            names = {t.ident: t.name for t in threading.enumerate()} if workers else {}
+            for ident, frame in frames.items():
+                if ident == self.thread_id:
+                    stack = _stack(frame, self.stop_frame)
+                elif ident in workers:
+                    stack = _stack(frame, workers[ident])
+                    if stack:
+                        stack.insert(0, (f"thread {names.get(ident, ident)}", "", 0))
+                else:
+                    continue
+                if stack:
+                    self.samples.append((stack, now - last))
+            last = now
+
+def attributed(func):
+    """
+    Wrap func, about to be submitted to a worker pool, so that the worker
+    running it is sampled for the profiled call submitting it (and so are
+    the tasks it submits in turn). Returns func itself outside a capture.
+    """
+    sampler = _capture.get()
+    if sampler is None:
+        return func
+
+    @functools.wraps(func)
+    def task(*args, **kwargs):
+        ident = threading.get_ident()
+        if ident == sampler.thread_id:
+            return func(*args, **kwargs)
+        token = _capture.set(sampler)
+        sampler.workers[ident] = sys._getframe()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            sampler.workers.pop(ident, None)
+            _capture.reset(token)
+    return task
+
+def speedscope(name, samples):
+    """
+    Sampled stacks as a speedscope (https://www.speedscope.app) document.
+    """
+    frames, index, stacks, weights = [], {}, [], []
+    for stack, weight in samples:
+        for frame in stack:
+            if frame not in index:
+                index[frame] = len(frames)
+                frames.append({"name": frame[0], "file": frame[1], "line": frame[2]})
+        stacks.append([index[frame] for frame in stack])
+        weights.append(weight)
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "shared": {"frames": frames},
+        "profiles": [{"type": "sampled", "name": name, "unit": "seconds", "startValue": 0,
+                      "endValue": sum(weights), "samples": stacks, "weights": weights}],
+        "name": name,
+        "activeProfileIndex": 0,
+        "exporter": "xrd-match-web",
+    }
+
+def folded(samples):
+    """
+    Sampled stacks in the folded format of flamegraph.pl (microseconds).
+    """
+    counts = {}
+    for stack, weight in samples:
+        key = ";".join(f"{name} ({os.path.basename(path)}:{line})" for name, path, line in stack)
+        counts[key] = counts.get(key, 0) + weight
+    return "".join(f"{key} {int(round(value * 1e6))}\n" for key, value in counts.items())
+
+def rotate(directory=PROFILE_DIR, max_bytes=PROFILE_MAX_BYTES):
+    """
+    Delete the oldest captures until the directory fits in max_bytes.
+    """
+    paths = sorted(glob.glob(os.path.join(directory, "*")), key=os.path.getmtime)
+    total = sum(os.path.getsize(p) for p in paths)
+    for path in paths:
+        if total <= max_bytes:
+            break
+        total -= os.path.getsize(path)
+        os.remove(path)
+
+def _save(name, tag, profile, samples):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    base = os.path.join(PROFILE_DIR, f"{name}-{tag}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(_capture_ids)}")
+    profile.dump_stats(base + ".prof")
+    with open(base + ".speedscope.json", "w") as f:
+        json.dump(speedscope(f"{name} {tag}", samples), f)
+    with open(base + ".folded", "w") as f:
+        f.write(folded(samples))
+    rotate()
+
+def profiled(func):
+    """
+    Capture cProfile stats (.prof, calling thread only) and sampled stacks
+    of the calling thread and the pool workers running its attributed tasks
+    (.speedscope.json and .folded flamegraph input) of calls to func in PROFILE_DIR, tagged with a hash
+    of the inputs. Generator functions are captured over their whole
+    iteration. The identity decorator when XRD_PROFILE is unset.
+    """
+    if PROFILE_MODE in ("", "0", "off"):
+        return func
+
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def generator_wrapper(*args, **kwargs):
+            if not _enabled():
+                yield from func(*args, **kwargs)
+                return
+            tag = input_hash(args, kwargs)
+            sampler = StackSampler(threading.get_ident(), sys._getframe())
+            profile = cProfile.Profile()
+            items = func(*args, **kwargs)
+            done = object()
+            sampler.start()
+            try:
+                while True:
+                    # Only the generator's own steps are profiled, not the consumer.
+                    token = _capture.set(sampler)
+                    try:
+                        item = profile.runcall(next, items, done)
+                    finally:
+                        _capture.reset(token)
+                    if item is done:
+                        return
+                    yield item
+            finally:
+                sampler.stopped.set()
+                sampler.join()
+                try:
+                    _save(func.__name__, tag, profile, sampler.samples)
+                except Exception as e:
+                    print("Error saving profile of", func.__name__, ":", e)
+        return generator_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _enabled():
+            return func(*args, **kwargs)
+        sampler = StackSampler(threading.get_ident(), sys._getframe())
+        profile = cProfile.Profile()
+        sampler.start()
+        token = _capture.set(sampler)
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            _capture.reset(token)
+            sampler.stopped.set()
+            sampler.join()
+            try:
+                _save(func.__name__, input_hash(args, kwargs), profile, sampler.samples)
+            except Exception as e:
+                print("Error saving profile of", func.__name__, ":", e)
+    return wrapper
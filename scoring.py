@@ -0,0 +1,149 @@
+import numpy as np
+from scipy.optimize import lsq_linear
+
+# Simulated and experimental peaks closer than this (degrees 2θ) are matched.
+MATCH_TOLERANCE = 0.2
+# Peaks below this percentage of the maximum intensity are ignored.
+PEAK_THRESHOLD = 5
+# FWHM (degrees 2θ) of the Gaussian used to turn sticks into a profile.
+PROFILE_FWHM = 0.1
+# Degree of the Legendre background fitted together with the phase scales.
+BACKGROUND_DEGREE = 3
+
+def find_peaks(two_theta, intensity, tolerance=MATCH_TOLERANCE, threshold=PEAK_THRESHOLD):
+    """
+    Locate peaks in an experimental scan: points that are the maximum within
+    ±tolerance and rise above the local minimum by threshold percent of the
+    scan maximum. Returns the sorted peak positions.
+    """
+    two_theta = np.asarray(two_theta, dtype=float)
+    intensity = np.asarray(intensity, dtype=float)
+    if len(two_theta) < 3:
+        return np.empty(0)
+    step = np.median(np.diff(two_theta))
+    w = max(1, int(round(tolerance / step))) if step > 0 else 1
+    windows = np.lib.stride_tricks.sliding_window_view(np.pad(intensity, w, mode="edge"), 2 * w + 1)
+    is_peak = (intensity >= windows.max(axis=1)) & (
+        intensity - windows.min(axis=1) > threshold / 100 * intensity.max()
+    )
+    # Flat tops produce runs of equal maxima; keep the first point of each run.
+    is_peak[1:] &= intensity[1:] != intensity[:-1]
+    return np.sort(two_theta[is_peak])
+
+def match_peaks(sim_two_theta, exp_peaks, tolerance=MATCH_TOLERANCE):
+    """
+    For each simulated peak position, return the signed offset (experimental
+    minus simulated) to the nearest experimental peak, or NaN if none lies
+    within tolerance. exp_peaks must be sorted.
+    """
+    sim_two_theta = np.asarray(sim_two_theta, dtype=float)
+    if len(exp_peaks) == 0:
+        return np.full(len(sim_two_theta), np.nan)
+    j = np.searchsorted(exp_peaks, sim_two_theta)
+    left = exp_peaks[np.clip(j - 1, 0, len(exp_peaks) - 1)] - sim_two_theta
+    right = exp_peaks[np.clip(j, 0, len(exp_peaks) - 1)] - sim_two_theta
+    offsets = np.where(np.abs(left) <= np.abs(right), left, right)
+    offsets[np.abs(offsets) > tolerance] = np.nan
+    return offsets
+
+def stick_profile(two_theta, intensity, grid, fwhm=PROFILE_FWHM):
+    """
+    Broaden sticks into Gaussian peaks of unit height scaled by intensity,
+    evaluated on grid (sorted). Each peak only touches grid points within
+    3 FWHM of its position.
+    """
+    two_theta = np.asarray(two_theta, dtype=float)
+    intensity = np.asarray(intensity, dtype=float)
+    grid = np.asarray(grid, dtype=float)
+    lo = np.searchsorted(grid, two_theta - 3 * fwhm)
+    hi = np.searchsorted(grid, two_theta + 3 * fwhm)
+    counts = hi - lo
+    peak = np.repeat(np.arange(len(two_theta)), counts)
+    pos = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+    values = intensity[peak] * np.exp(-4 * np.log(2) * ((grid[pos] - two_theta[peak]) / fwhm) ** 2)
+    return np.bincount(pos, weights=values, minlength=len(grid))
+
+def rwp(observed, calculated, two_theta=None):
+    """
+    Weighted-profile R factor (percent) with weights 1/observed, after a
+    weighted least-squares fit of a scale factor and a linear background.
+    """
+    observed = np.asarray(observed, dtype=float)
+    weights = 1 / np.maximum(observed, 1e-3 * observed.max())
+    x = np.linspace(-1, 1, len(observed)) if two_theta is None else np.asarray(two_theta, dtype=float)
+    design = np.column_stack((calculated, np.ones_like(observed), x))
+    root_w = np.sqrt(weights)
+    coeffs = np.linalg.lstsq(design * root_w[:, None], observed * root_w, rcond=None)[0]
+    residual = observed - design @ coeffs
+    return 100 * np.sqrt(np.sum(weights * residual ** 2) / np.sum(weights * observed ** 2))
+
+def fit_phase_scales(profiles, observed, two_theta, degree=BACKGROUND_DEGREE):
+    """
+    Non-negative scale factors of phase profiles (phase x point, on the
+    two_theta grid) plus a polynomial background, fitted to observed in one
+    bounded linear least-squares solve with the same 1/observed weights as
+    rwp. Returns (scales, background).
+    """
+    profiles = np.atleast_2d(np.asarray(profiles, dtype=float))
+    observed = np.asarray(observed, dtype=float)
+    two_theta = np.asarray(two_theta, dtype=float)
+    span = two_theta[-1] - two_theta[0]
+    x = 2 * (two_theta - two_theta[0]) / span - 1 if span > 0 else np.zeros_like(two_theta)
+    basis = np.polynomial.legendre.legvander(x, degree)
+    design = np.column_stack((profiles.T, basis))
+    root_w = np.sqrt(1 / np.maximum(observed, 1e-3 * observed.max()))
+    # Unit-norm columns keep the solve well conditioned.
+    norms = np.linalg.norm(design * root_w[:, None], axis=0)
+    norms[norms == 0] = 1
+    n = len(profiles)
+    lower = np.r_[np.zeros(n), np.full(degree + 1, -np.inf)]
+    result = lsq_linear(design * root_w[:, None] / norms, observed * root_w, bounds=(lower, np.inf))
+    coeffs = result.x / norms
+    return coeffs[:n], basis @ coeffs[n:]
+
+def weight_fractions(scales, masses, volumes):
+    """
+    Hill-Howard weight fractions W_i = S_i (ZM)_i V_i / sum_j S_j (ZM)_j V_j
+    from Rietveld-type scale factors, cell masses and cell volumes.
+    """
+    products = np.asarray(scales, dtype=float) * np.asarray(masses, dtype=float) * np.asarray(volumes, dtype=float)
+    total = products.sum()
+    return products / total if total > 0 else np.zeros_like(products)
+
+def score_pattern(two_theta, intensity, exp_two_theta, exp_intensity, exp_peaks=None,
+                  tolerance=MATCH_TOLERANCE, threshold=PEAK_THRESHOLD, fwhm=PROFILE_FWHM):
+    """
+    Figures of merit of a simulated stick pattern against an experimental scan.
+    Only simulated peaks inside the scan range and above threshold percent of
+    the strongest one are counted. Pass precomputed exp_peaks (from find_peaks)
+    when scoring several phases against the same scan.
+    """
+    two_theta = np.asarray(two_theta, dtype=float)
+    intensity = np.asarray(intensity, dtype=float)
+    exp_two_theta = np.asarray(exp_two_theta, dtype=float)
+    exp_intensity = np.asarray(exp_intensity, dtype=float)
+    if exp_peaks is None:
+        exp_peaks = find_peaks(exp_two_theta, exp_intensity, tolerance, threshold)
+
+    in_range = (two_theta >= exp_two_theta[0]) & (two_theta <= exp_two_theta[-1])
+    strong = in_range & (intensity > threshold / 100 * intensity.max(initial=0))
+    offsets = match_peaks(two_theta[strong], exp_peaks, tolerance)
+    matched = ~np.isnan(offsets)
+    profile = stick_profile(two_theta[in_range], intensity[in_range], exp_two_theta, fwhm)
+    return {
+        "matched": int(matched.sum()),
+        "unmatched": int((~matched).sum()),
+        "mean_shift": float(offsets[matched].mean()) if matched.any() else None,
+        "mean_abs_shift": float(np.abs(offsets[matched]).mean()) if matched.any() else None,
+        "rwp": float(rwp(exp_intensity, profile, exp_two_theta)),
+    }
+
+def format_score(score):
+    """
+    One-line summary of a score_pattern result for display.
+    """
+    total = score["matched"] + score["unmatched"]
+    text = f"Matched {score['matched']}/{total} peaks"
+    if score["mean_shift"] is not None:
+        text += f" · Δ2θ {score['mean_shift']:+.3f}° (mean |Δ| {score['mean_abs_shift']:.3f}°)"
+    return text + f" · Rwp {score['rwp']:.1f}%"
@@ -0,0 +1,104 @@
+import os
+import glob
+import hashlib
+import tempfile
+from functools import lru_cache
+import numpy as np
+from preprocess import parse_xy
+
+# Resampled series are stored here as .npy files and memory-mapped on load.
+SERIES_DIR = os.environ.get("XRD_SERIES_DIR", os.path.join(tempfile.gettempdir(), "xrd-series"))
+# Cap on grid points per scan and on the disk used by all stored series.
+SERIES_MAX_POINTS = 20000
+SERIES_MAX_BYTES = 2 * 1024 ** 3
+
+def series_id(contents_list):
+    """
+    Content hash identifying a series (order of the scans matters).
+    """
+    digest = hashlib.sha1()
+    for contents in contents_list:
+        digest.update(contents.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def _paths(sid):
+    return os.path.join(SERIES_DIR, f"{sid}.npy"), os.path.join(SERIES_DIR, f"{sid}.grid.npy")
+
+def build_series(contents_list):
+    """
+    Resample uploaded .xy scans onto one shared 2θ grid and store them as a
+    (scan x point) float32 array on disk. The grid takes its range and step
+    from the first scan (step widened if needed to stay within
+    SERIES_MAX_POINTS); points a scan does not cover are NaN. Scans are
+    parsed one at a time straight into the memory-mapped output, so memory
+    use does not grow with the length of the series. Returns the series id.
+    """
+    sid = series_id(contents_list)
+    data_path, grid_path = _paths(sid)
+    if os.path.exists(data_path) and os.path.exists(grid_path):
+        return sid
+    os.makedirs(SERIES_DIR, exist_ok=True)
+
+    grid = None
+    tmp_path = f"{data_path}.{os.getpid()}.tmp"
+    try:
+        for i, contents in enumerate(contents_list):
+            df = parse_xy(contents).sort_values('2_theta')
+            two_theta = df['2_theta'].to_numpy(dtype=float)
+            intensity = df['intensity'].to_numpy(dtype=float)
+            if grid is None:
+                step = max(np.median(np.diff(two_theta)), (two_theta[-1] - two_theta[0]) / (SERIES_MAX_POINTS - 1))
+                grid = np.arange(two_theta[0], two_theta[-1] + step / 2, step)
+                data = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32,
+                                                 shape=(len(contents_list), len(grid)))
+            row = np.interp(grid, two_theta, intensity, left=np.nan, right=np.nan)
+            data[i] = row / np.fmax.reduce(row) * 100
+        data.flush()
+        del data
+        np.save(f"{grid_path}.{os.getpid()}.tmp.npy", grid)
+        os.replace(f"{grid_path}.{os.getpid()}.tmp.npy", grid_path)
+        os.replace(tmp_path, data_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    _evict_series(keep=sid)
+    return sid
+
+def _evict_series(keep):
+    """
+    Delete the least recently used series until the directory fits in
+    SERIES_MAX_BYTES.
+    """
+    sizes, used = {}, {}
+    for path in glob.glob(os.path.join(SERIES_DIR, "*.npy")):
+        sid = os.path.basename(path).split(".")[0]
+        sizes[sid] = sizes.get(sid, 0) + os.path.getsize(path)
+        used[sid] = max(used.get(sid, 0), os.path.getatime(path))
+    total = sum(sizes.values())
+    for sid in sorted(used, key=used.get):
+        if total <= SERIES_MAX_BYTES:
+            break
+        if sid == keep:
+            continue
+        for path in _paths(sid):
+            if os.path.exists(path):
+                os.remove(path)
+        total -= sizes[sid]
+
+@lru_cache(maxsize=4)
+def load_series(sid):
+    """
+    Memory-map a stored series; returns (grid, data) with data read-only.
+    """
+    data_path, grid_path = _paths(sid)
+    return np.load(grid_path), np.load(data_path, mmap_mode="r")
+
+def series_scan(sid, index):
+    """
+    One scan of a series as (two_theta, intensity), without the NaN padding.
+    """
+    grid, data = load_series(sid)
+    row = np.asarray(data[index], dtype=float)
+    valid = ~np.isnan(row)
+    return grid[valid], row[valid]
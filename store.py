@@ -0,0 +1,124 @@
+import os
+import glob
+import json
+import time
+import uuid
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+# Content-addressed store of computed arrays shared by all worker processes
+# (and kept across restarts). Each entry is a directory of .npy files plus
+# meta.json, named <key>.<tag>; XRD_STORE=0 disables it.
+STORE_ENABLED = os.environ.get("XRD_STORE", "1") not in ("0", "off", "")
+STORE_DIR = os.environ.get("XRD_STORE_DIR", os.path.join(tempfile.gettempdir(), "xrd-store"))
+STORE_MAX_BYTES = int(float(os.environ.get("XRD_STORE_MAX_MB", 1024)) * 1024 ** 2)
+
+def content_key(*parts):
+    """
+    sha1 of the given parts (str, bytes or anything with a stable repr).
+    """
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        elif not isinstance(part, bytes):
+            part = repr(part).encode()
+        digest.update(part)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def _entries(key):
+    return glob.glob(os.path.join(STORE_DIR, f"{key}.*"))
+
+def _dir_size(path):
+    return sum(os.path.getsize(p) for p in glob.glob(os.path.join(path, "*")))
+
+def load_entry(key, accept=lambda meta: True):
+    """
+    (meta, arrays) of a stored entry of key whose meta passes accept, with
+    the arrays memory-mapped read-only; None if there is none.
+    """
+    if not STORE_ENABLED:
+        return None
+    for path in _entries(key):
+        try:
+            with open(os.path.join(path, "meta.json")) as f:
+                meta = json.load(f)
+            if not accept(meta):
+                continue
+            arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in meta["arrays"]}
+            # The directory mtime is the last use, for eviction.
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            # Evicted or replaced by another worker meanwhile.
+            continue
+        return meta, arrays
+    return None
+
+def save_entry(key, tag, meta, arrays, supersedes=lambda meta: False):
+    """
+    Store arrays (name -> ndarray) and meta under key. The entry is written
+    to a temporary directory and renamed into place, so readers never see
+    a partial entry; if another worker stored the same entry first, this
+    copy is dropped. Entries of key whose meta passes supersedes are removed.
+    """
+    if not STORE_ENABLED:
+        return
+    os.makedirs(STORE_DIR, exist_ok=True)
+    final = os.path.join(STORE_DIR, f"{key}.{tag}")
+    tmp = os.path.join(STORE_DIR, f".tmp-{uuid.uuid4().hex}")
+    os.makedirs(tmp)
+    try:
+        for name, values in arrays.items():
+            np.save(os.path.join(tmp, f"{name}.npy"), np.ascontiguousarray(values))
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump(dict(meta, arrays=list(arrays)), f)
+        try:
+            os.rename(tmp, final)
+        except OSError:
+            return
+    finally:
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp, ignore_errors=True)
+    for path in _entries(key):
+        if path == final:
+            continue
+        try:
+            with open(os.path.join(path, "meta.json")) as f:
+                old = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if supersedes(old):
+            shutil.rmtree(path, ignore_errors=True)
+    evict()
+
+def evict(max_bytes=STORE_MAX_BYTES):
+    """
+    Delete the least recently used entries until the store fits in
+    max_bytes. Workers serialize on an flock so they do not race.
+    """
+    os.makedirs(STORE_DIR, exist_ok=True)
+    with open(os.path.join(STORE_DIR, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        entries = []
+        for path in glob.glob(os.path.join(STORE_DIR, "*.*")):
+            try:
+                entries.append((os.path.getmtime(path), _dir_size(path), path))
+            except OSError:
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+        # Temporary directories left behind by killed workers.
+        for path in glob.glob(os.path.join(STORE_DIR, ".tmp-*")):
+            try:
+                if time.time() - os.path.getmtime(path) > 3600:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                continue